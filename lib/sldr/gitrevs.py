@@ -0,0 +1,97 @@
+# -*- coding: utf-8
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import os, subprocess
+
+class GitRevisions(object):
+    """ Maps files to the last git commit that changed them, and its date, from a single
+        git log over the given paths, rather than a git log per file. The log is run in
+        cwd, with paths relative to that. Files are looked up by any path to them. """
+
+    def __init__(self, paths=['.'], revrange=None, cwd=None):
+        self.cwd = os.path.abspath(cwd or '.')
+        self.revs = {}
+        top = self._git('rev-parse', '--show-toplevel').strip()
+        cmd = ['-c', 'core.quotepath=off', 'log', '--cc', '--name-only', '--format=%x01%H %ci']
+        if revrange is not None:
+            cmd.append(revrange)
+        commit = None
+        for l in self._git(*(cmd + ['--'] + list(paths))).splitlines():
+            if l.startswith('\x01'):
+                commit = tuple(l[1:].split(' ', 1))
+            elif l and commit is not None:
+                # the log is newest first, so keep the first commit seen for each file
+                self.revs.setdefault(os.path.join(top, l), commit)
+
+    def _git(self, *args):
+        return subprocess.check_output(['git'] + list(args), cwd=self.cwd).decode("utf-8")
+
+    def _key(self, fname):
+        return os.path.realpath(fname)
+
+    def get(self, fname, default=None):
+        """ Returns (commit id, date) for the last change to fname """
+        return self.revs.get(self._key(fname), default)
+
+    def revid(self, fname):
+        """ Returns the commit id of the last change to fname, or None """
+        res = self.revs.get(self._key(fname), None)
+        return res[0] if res is not None else None
+
+    def __len__(self):
+        return len(self.revs)
+
+
+class GitObjects(object):
+    """ Reads files as they were at given revisions through one long running
+        git cat-file --batch, rather than a git show per file. """
+
+    def __init__(self, cwd=None):
+        self.cwd = os.path.abspath(cwd or '.')
+        self.top = os.path.realpath(subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
+                                        cwd=self.cwd).decode("utf-8").strip())
+        self.proc = None
+
+    def show(self, rev, fname):
+        """ Returns the contents of fname, a path from the current directory, at rev,
+            or None if it did not exist there """
+        if self.proc is None:
+            self.proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=self.cwd,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        path = os.path.relpath(os.path.realpath(fname), self.top).replace(os.sep, '/')
+        self.proc.stdin.write("{}:{}\n".format(rev, path).encode("utf-8"))
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().decode("utf-8").rstrip("\n").rsplit(" ", 2)
+        if len(header) != 3 or not header[2].isdigit():
+            return None         # missing or ambiguous
+        res = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)
+        return res.decode("utf-8")
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
@@ -25,10 +25,24 @@
 
 from xml.etree import ElementTree as et
 from xml.etree import ElementPath as ep
-import os, re, csv
+import os, re, csv, sys, mmap, struct, hashlib, tempfile, functools, zlib, json
+from array import array
+from collections import OrderedDict, namedtuple
 from itertools import combinations
 from six import with_metaclass
 
+# what LangTags.lookup_many found for a tag: the form found, the canonical and maximal forms
+# of its LangTag, and the index of the fallback that found it, or None
+TagMatch = namedtuple('TagMatch', ['tag', 'found', 'canonical', 'maximal', 'langtag', 'fallback'])
+# a tag lookup_many couldn't find, with each form it tried
+TagMiss = namedtuple('TagMiss', ['tag', 'tried'])
+
+def _partition(tag):
+    """ Returns the language subtag a tag, or the name of a locale, is kept under. Every tag
+        in an equivalence set, and every source entry that can change the set, has the same
+        one, so the sets for one can be made without looking at the others. """
+    return tag.split('-', 1)[0].split('_', 1)[0].lower()
+
 def powerset(x):
     return sum(([set(y) for y in combinations(x, i)] for i in range(len(x)+1)), [])
 
@@ -39,18 +53,21 @@ class Singleton(type):
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
+_sharedsubtags = {}
+
+def _shared(x):
+    """ Returns the one copy of the tuple of subtags x """
+    return _sharedsubtags.setdefault(x, x)
+
 class LangTag(object) :
+    """ A language tag. There are a great many of these, so they are slotted, their
+        subtags are interned, and variants are kept as a tuple and extensions as a dict
+        of tuples, each shared by every tag with the same. Other attributes can still be
+        set, and go in a dict made for the tags that need one. """
 
-    lang = None
-    script = None
-    region = None
-    variants = None
-    extensions = None
-    hidescript = False
-    hideregion = False
-    hideboth = True
-    skip = False
-    base = None
+    __slots__ = ('lang', 'script', 'region', 'variants', 'extensions', 'hidescript', 'hideregion',
+                 'hideboth', 'hidevariants', 'hideextensions', 'skip', '_base', 'desc', 'mode',
+                 'suppress', 'deprecated', 'preferred', 'isCldr', '__dict__')
 
     def __init__(self, tag=None, lang=None, script=None, region=None, variants=None, extensions=None) :
         self.lang = lang
@@ -59,12 +76,43 @@ class LangTag(object) :
         self.hideboth = (self.script is None and self.region is None)
         self.variants = variants
         self.extensions = extensions
-        self.base = []
+        self._base = None
         self.hidescript = False
         self.hideregion = False
         self.hidevariants = None
         self.hideextensions = None
-        if tag is not None : self.parse(tag)
+        self.skip = False
+        if tag is None :
+            self._share()
+        elif lang is None and script is None and region is None and variants is None and extensions is None :
+            (self.lang, self.script, self.region, self.hideboth, self.variants, extensions) = _parsetag(tag)
+            if extensions is not None :
+                self.extensions = dict(extensions)
+        else :
+            self._parse(tag)
+            self._share()
+
+    @property
+    def base(self):
+        """ The list of tags this tag is based on, made when first asked for """
+        if self._base is None:
+            self._base = []
+        return self._base
+
+    @base.setter
+    def base(self, value):
+        self._base = value
+
+    def _share(self):
+        """ Interns the subtags, and shares the variants and extensions """
+        if self.lang is not None: self.lang = sys.intern(self.lang)
+        if self.script is not None: self.script = sys.intern(self.script)
+        if self.region is not None: self.region = sys.intern(self.region)
+        if self.variants is not None:
+            self.variants = _shared(tuple(sys.intern(v) for v in self.variants))
+        if self.extensions is not None:
+            self.extensions = {sys.intern(k): _shared(tuple(sys.intern(x) for x in v))
+                                    for k, v in self.extensions.items()}
 
     def copy(self):
         res = type(self)(lang=self.lang, script=self.script, region=self.region,
@@ -116,6 +164,10 @@ class LangTag(object) :
         return repr(self) < repr(other)
 
     def parse(self, x) :
+        self._parse(x)
+        self._share()
+
+    def _parse(self, x) :
         ''' cheap and nasty langtag parser '''
         params = {}
         bits = x.replace('_', '-').split('-')
@@ -249,7 +301,7 @@ class LangTag(object) :
             for ev in sorted(extravars):
                 for en in sorted(extraexts):
                     res.append("-".join(x for x in [self.lang] + s + [ev, en] if x is not None and len(x)))
-        for b in self.base:
+        for b in (self._base or ()):
             if b in history or b == self:
                 continue
             if len(res) == 1:
@@ -265,11 +317,46 @@ class LangTag(object) :
         if self.extensions != other.extensions : return False
         return True
 
+    def _analysiskey(self):
+        return (self.lang, self.script, self.region, self.variants,
+                tuple(sorted(self.extensions.items())) if self.extensions is not None else None,
+                self.hidescript, self.hideregion, self.hideboth, bool(getattr(self, 'desc', None)))
+
+    def _analysis(self):
+        return (self.lang, self.script, self.region, self.variants, self.extensions,
+                self.hidescript, self.hideregion, self.hideboth, getattr(self, 'desc', None))
+
+    def _setanalysis(self, a):
+        (self.lang, self.script, self.region, self.variants, extensions,
+                self.hidescript, self.hideregion, self.hideboth, desc) = a
+        self.extensions = dict(extensions) if extensions is not None else None
+        if desc is not None:
+            self.desc = desc
+
     def analyse(self, alltags = None) :
         if alltags is None :
             alltags = LangTags()
         if str(self) in alltags :
             return alltags[str(self)]
+        # alltags.analyses holds what analysing a tag made of it, while alltags is unchanged
+        cache = getattr(alltags, 'analyses', None)
+        if cache is None :
+            return self._analyse(alltags)
+        key = self._analysiskey()
+        res = cache.get(key, None)
+        if res is not None :
+            alltags.analysehits += 1
+            cache.move_to_end(key)
+            self._setanalysis(res)
+            return self
+        alltags.analysemisses += 1
+        self._analyse(alltags)
+        cache[key] = self._analysis()
+        if len(cache) > alltags.maxanalyses :
+            cache.popitem(last=False)
+        return self
+
+    def _analyse(self, alltags) :
         if self.region is not None :
             if self.region == "ZZ":
                 self.region = None
@@ -304,18 +391,209 @@ class LangTag(object) :
         return self
 
 
+@functools.lru_cache(maxsize=4096)
+def _parsetag(tag):
+    """ Returns (lang, script, region, hideboth, variants, extensions) for a tag string, as
+        parsed into a new LangTag, with extensions as a tuple of (singleton, subtags).
+        Results are cached. """
+    t = LangTag()
+    t.parse(tag)
+    return (t.lang, t.script, t.region, t.hideboth, t.variants,
+            tuple(sorted(t.extensions.items())) if t.extensions is not None else None)
+
+
+class _OffsetTable(object):
+    """ The strings in a blob, found through an array of their offsets """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self.offsets) - 1:
+            raise IndexError(i)
+        return bytes(self.blob[self.offsets[i]:self.offsets[i+1]])
+
+
+class LangTagsIndex(object):
+    """ A compiled langtags.txt, read through mmap so that nothing is parsed until it is
+        asked for. It holds a sorted table of every tag, each with the number of the last
+        line it is on, an open addressed hash table, by crc32, of their places in the
+        sorted table, and the lines of equivalent tags themselves, space separated. The
+        numbers are in the machine's byte order, so an index is only for the machine that
+        built it. """
+
+    _magic = b'SLDRLTX2'
+    _header = struct.Struct('=8s32sIIIII')
+
+    def __init__(self, fname):
+        with open(fname, 'rb') as inf:
+            self.data = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.key, nkeys, nlines, nslots, keysize, linesize) = self._header.unpack_from(self.data, 0)
+        if magic != self._magic:
+            raise ValueError("{} is not a langtags index".format(fname))
+        view = memoryview(self.data)
+        pos = self._header.size
+        def ints(n):
+            nonlocal pos
+            res = view[pos:pos+4*n].cast('I')
+            pos += 4*n
+            return res
+        keyoffsets = ints(nkeys + 1)
+        self.keylines = ints(nkeys)
+        self.slots = ints(nslots)
+        lineoffsets = ints(nlines + 1)
+        self.keys = _OffsetTable(keyoffsets, view[pos:pos+keysize])
+        pos += keysize
+        self.lines = _OffsetTable(lineoffsets, view[pos:pos+linesize])
+
+    @classmethod
+    def build(cls, fname, lines, key):
+        """ Writes an index of lines, each a list of equivalent tags, to fname. key is a
+            32 byte digest of the sources, to tell whether the index is up to date. """
+        keylines = {}
+        for i, l in enumerate(lines):
+            for t in l:
+                keylines[t] = i
+        keys = sorted((k.encode("utf-8"), v) for k, v in keylines.items())
+        linestrs = [" ".join(l).encode("utf-8") for l in lines]
+        def offsets(blobs):
+            res = array('I', [0])
+            for b in blobs:
+                res.append(res[-1] + len(b))
+            return res
+        keyblob = b"".join(k for k, v in keys)
+        lineblob = b"".join(linestrs)
+        # each slot holds 1 + the place of a key, or 0 if empty, and at most half are used
+        nslots = 1
+        while nslots < 2 * len(keys):
+            nslots <<= 1
+        slots = array('I', [0]) * nslots
+        for i, (k, v) in enumerate(keys):
+            h = zlib.crc32(k) & (nslots - 1)
+            while slots[h]:
+                h = (h + 1) & (nslots - 1)
+            slots[h] = i + 1
+        d = os.path.dirname(fname)
+        os.makedirs(d, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=d, delete=False) as outf:
+            outf.write(cls._header.pack(cls._magic, key, len(keys), len(lines), nslots,
+                                        len(keyblob), len(lineblob)))
+            offsets(k for k, v in keys).tofile(outf)
+            array('I', [v for k, v in keys]).tofile(outf)
+            slots.tofile(outf)
+            offsets(linestrs).tofile(outf)
+            outf.write(keyblob)
+            outf.write(lineblob)
+        os.replace(outf.name, fname)
+
+    def __len__(self):
+        return len(self.keylines)
+
+    def find(self, tag):
+        """ Returns the number of the line tag is on, or -1 """
+        k = tag.encode("utf-8")
+        slots = self.slots
+        mask = len(slots) - 1
+        offsets = self.keys.offsets
+        blob = self.keys.blob
+        h = zlib.crc32(k) & mask
+        while True:
+            i = slots[h]
+            if not i:
+                return -1
+            if blob[offsets[i-1]:offsets[i]] == k:
+                return self.keylines[i-1]
+            h = (h + 1) & mask
+
+    def line(self, i):
+        """ Returns the tags on line i """
+        return self.lines[i].decode("utf-8").split(" ")
+
+    def tags(self):
+        """ Yields every tag in the index and the number of its line """
+        offsets = self.keys.offsets
+        blob = self.keys.blob
+        for i, lnum in enumerate(self.keylines):
+            yield (str(blob[offsets[i]:offsets[i+1]], "utf-8"), lnum)
+
+
+def _readsupplemental(fname=None):
+    """ Returns dicts of each language in supplementalData.xml to its scripts, and to the
+        regions it is spoken in """
+    scripts = {}
+    territories = {}
+    regions = {}
+    if fname is None :
+        fname = os.path.join(os.path.dirname(__file__), 'supplementalData.xml')
+    doc = et.parse(fname)
+    ps = doc.getroot().find('languageData')
+    for p in ps.findall('language') :
+        lang = p.get('type')
+        ss = scripts.get(lang, [])
+        ts = territories.get(lang, [])
+        if p.get('scripts') :
+            ss += p.get('scripts').split(' ')
+            scripts[lang] = ss
+        if p.get('territories') :
+            ts += p.get('territories').split(' ')
+            territories[lang] = ts
+    ps = doc.getroot().find('territoryInfo')
+    for p in ps.findall('territory') :
+        r = p.get('type')
+        for l in p.findall('languagePopulation') :
+            lt = l.get('type')
+            if lt not in regions : regions[lt] = []
+            regions[lt].append(r)
+    return (scripts, regions)
+
+
 class LangTags(with_metaclass(Singleton, dict)):
+    """ A dict of every tag to the LangTag of its equivalent tags. When read from
+        langtags.txt, this is through a LangTagsIndex compiled into cachedir, and the
+        LangTags for a line are only made when one of its tags is first looked up. """
+
+    use_index = True
+    cachedir = os.environ.get('SLDR_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'sldr'))
+    maxanalyses = 1 << 14
+    _indexversion = 2
 
-    def __init__(self, extrasfile=None, noalltags=False, alltags=None):
+    def __init__(self, extrasfile=None, noalltags=False, alltags=None, langs=None, sources=None):
         super(LangTags, self).__init__()
         self.variants = {}
         self.global_variants = []
+        self.index = None
+        self.langs = set(langs) if langs is not None else None
+        self.analyses = OrderedDict()
+        self.analysehits = 0
+        self.analysemisses = 0
         if noalltags or not self.readAlltags(alltags):
-            self.readIana()
-            self.readLikelySubtags()
-            if extrasfile is not None :
-                self.readExtras(extrasfile)
-            self.readSupplementalData()
+            self.readSources(extrasfile, **(sources or {}))
+
+    @classmethod
+    def build(cls, langs=None, extrasfile=None, iana=None, likely=None, supplemental=None):
+        """ Returns a new LangTags, apart from the shared one, made from the sources rather
+            than langtags.txt. If langs is given, only the tags whose language subtag is in
+            it are made, and they are the same as in a LangTags made from everything. """
+        res = cls.__new__(cls)      # not cls(), which is the shared one
+        res.__init__(extrasfile, noalltags=True, langs=langs,
+                     sources={'iana': iana, 'likely': likely, 'supplemental': supplemental})
+        return res
+
+    def readSources(self, extrasfile=None, iana=None, likely=None, supplemental=None):
+        """ Reads the tags from the IANA registry and CLDR data, or the given files of them """
+        self.readIana(iana)
+        self.readLikelySubtags(likely)
+        if extrasfile is not None :
+            self.readExtras(extrasfile)
+        self.readSupplementalData(supplemental)
+
+    def wanted(self, tag):
+        """ Returns whether tag is one of the languages being made """
+        return self.langs is None or _partition(tag) in self.langs
 
     def readAlltags(self, fname=None):
         if fname is not None:
@@ -324,25 +602,131 @@ class LangTags(with_metaclass(Singleton, dict)):
             fname = [os.path.join(os.path.dirname(__file__), 'langtags.txt')]
         for p in fname:
             try:
-                with open(p, encoding="utf-8") as fh:
-                    for l in fh.readlines():
-                        tags = [x[1:] if x.startswith("*") else x for x in l.strip().split() if x != "="]
-                        temp = {}
-                        t = tags.pop()
-                        ltag = LangTag(tag=t)
-                        self[t] = ltag
-                        for t in tags:
-                            lt = LangTag(tag=t)
-                            if ltag.lang == lt.lang:
-                                if lt.script is None and lt.region is None:
-                                    lt.hideboth = True
-                                ltag.merge_equivalent(lt)
-                            self[t] = ltag
+                if self.use_index and self.cachedir:
+                    self.index = self.readIndex(p)
+                    if self.index is not None:
+                        return True
+                for l in self._readlines(p):
+                    self._addline(l)
                 return True
             except IOError:
                 continue
         return False
 
+    def _readlines(self, fname):
+        with open(fname, encoding="utf-8") as fh:
+            return [l for l in (self._splitline(x) for x in fh.readlines()) if len(l)]
+
+    def _splitline(self, l):
+        return [x[1:] if x.startswith("*") else x for x in l.strip().split() if x != "="]
+
+    def _addline(self, tags, lnum=None):
+        """ Adds the tags on a line of langtags.txt, all to the LangTag of the last. For
+            a line from the index, only the tags it gives this line for are added, and only
+            if they aren't there already. """
+        tags = list(tags)
+        t = tags.pop()
+        ltag = LangTag(tag=t)
+        if lnum is None or (not dict.__contains__(self, t) and self.index.find(t) == lnum):
+            dict.__setitem__(self, t, ltag)
+        for t in tags:
+            lt = LangTag(tag=t)
+            if ltag.lang == lt.lang:
+                if lt.script is None and lt.region is None:
+                    lt.hideboth = True
+                ltag.merge_equivalent(lt)
+            if lnum is None or (not dict.__contains__(self, t) and self.index.find(t) == lnum):
+                dict.__setitem__(self, t, ltag)
+        return ltag
+
+    def readIndex(self, fname):
+        """ Returns the LangTagsIndex of fname in cachedir, compiling it first if it is
+            missing or out of date, or None if it can't be made. """
+        with open(fname, 'rb') as inf:
+            key = hashlib.sha256(inf.read())
+        key.update("{} {}".format(self._indexversion, sys.byteorder).encode("utf-8"))
+        key = key.digest()
+        idxname = os.path.join(self.cachedir, 'langtags', key.hex()[:16] + '.idx')
+        try:
+            res = LangTagsIndex(idxname)
+            if res.key == key:
+                return res
+        except (OSError, ValueError, struct.error):     # missing or unreadable, so rebuild it
+            pass
+        lines = self._readlines(fname)
+        try:
+            LangTagsIndex.build(idxname, lines, key)
+            return LangTagsIndex(idxname)
+        except (OSError, ValueError):
+            return None
+
+    def _fromindex(self, tag):
+        """ Makes the LangTags for the line of the index that tag is on. Returns whether
+            there was one. """
+        if self.index is None:
+            return False
+        lnum = self.index.find(tag)
+        if lnum < 0:
+            return False
+        self._addline(self.index.line(lnum), lnum)
+        return True
+
+    def _loadall(self):
+        """ Makes the LangTags for every line of the index not yet looked at """
+        if self.index is None:
+            return
+        for t, lnum in self.index.tags():
+            if not dict.__contains__(self, t):
+                self._addline(self.index.line(lnum), lnum)
+        self.index = None
+
+    def changed(self):
+        """ Forgets the analyses made against these tags. Anything that changes a LangTag
+            in here in place, rather than through add, should call this. """
+        self.analyses.clear()
+
+    def cachestats(self):
+        """ Returns the hits and misses of the tag parsing and analysis caches """
+        p = _parsetag.cache_info()
+        return {'parse': {'hits': p.hits, 'misses': p.misses, 'size': p.currsize},
+                'analyse': {'hits': self.analysehits, 'misses': self.analysemisses,
+                            'size': len(self.analyses)}}
+
+    def __setitem__(self, tag, value):
+        self.analyses.clear()
+        dict.__setitem__(self, tag, value)
+
+    def __missing__(self, tag):
+        if self._fromindex(tag) and dict.__contains__(self, tag):
+            return dict.__getitem__(self, tag)
+        raise KeyError(tag)
+
+    def __contains__(self, tag):
+        return dict.__contains__(self, tag) or (self.index is not None and self.index.find(tag) >= 0)
+
+    def get(self, tag, default=None):
+        return self[tag] if tag in self else default
+
+    def __len__(self):
+        self._loadall()
+        return dict.__len__(self)
+
+    def __iter__(self):
+        self._loadall()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._loadall()
+        return dict.keys(self)
+
+    def values(self):
+        self._loadall()
+        return dict.values(self)
+
+    def items(self):
+        self._loadall()
+        return dict.items(self)
+
     def readLikelySubtags(self, fname = None) :
         """Reads the likely subtag mappings"""
         if fname is None :
@@ -350,6 +734,7 @@ class LangTags(with_metaclass(Singleton, dict)):
         doc = et.parse(fname)
         ps = doc.getroot().find('likelySubtags')
         for p in ps.findall('likelySubtag') :
+            if not self.wanted(p.get('to')): continue
             to = LangTag(p.get('to'))
             base = LangTag(p.get('from'))
             if base.lang == 'und': continue
@@ -365,6 +750,7 @@ class LangTags(with_metaclass(Singleton, dict)):
             reader = csv.DictReader(csvfile, delimiter="\t")
             for row in reader :
                 if row['confirmed'] == 'CLDR' : continue
+                if not self.wanted(row['likely_subtag']) : continue
                 base = LangTag(row['langtag'])
                 to = LangTag(row['likely_subtag']).analyse(self)
                 if base.script is None : to.hidescript = True
@@ -388,7 +774,7 @@ class LangTags(with_metaclass(Singleton, dict)):
                         hasprefix = False
                         currlang = None
                     mode = l[6:]
-                    if currlang is not None:
+                    if currlang is not None and self.wanted(tag.lang):
                         self.add(tag)
                     currlang = None
                     tag = None
@@ -415,42 +801,20 @@ class LangTags(with_metaclass(Singleton, dict)):
                     tag.desc.append(l[13:].strip())
                 elif l.startswith("Prefix: ") and mode == "extlang" and tag is not None:
                     tag.lang = l[8:] + "-" + tag.lang
-            if currlang is not None:
+            if currlang is not None and self.wanted(tag.lang):
                 self.add(tag)
 
     def readSupplementalData(self, fname = None) :
         """Reads supplementalData.xml from CLDR to get useful structural information on LDML"""
-        scripts = {}
-        territories = {}
-        regions = {}
-        if fname is None :
-            fname = os.path.join(os.path.dirname(__file__), 'supplementalData.xml')
-        doc = et.parse(fname)
-        ps = doc.getroot().find('languageData')
-        for p in ps.findall('language') :
-            lang = p.get('type')
-            ss = scripts.get(lang, [])
-            ts = territories.get(lang, [])
-            if p.get('scripts') :
-                ss += p.get('scripts').split(' ')
-                scripts[lang] = ss
-            if p.get('territories') :
-                ts += p.get('territories').split(' ')
-                territories[lang] = ts
-        ps = doc.getroot().find('territoryInfo')
-        for p in ps.findall('territory') :
-            r = p.get('type')
-            for l in p.findall('languagePopulation') :
-                lt = l.get('type')
-                if lt not in regions : regions[lt] = []
-                regions[lt].append(r)
+        (scripts, regions) = _readsupplemental(fname)
         # set default scripts and regions based on there being only one for a language
         for l, r in regions.items() :
-            if len(r) > 1 : continue
+            if len(r) > 1 or not self.wanted(l) : continue
             r = r[0]
             t = LangTag(l)      # could include script
             if str(t) in self :
                 t = self[str(t)]
+                self.changed()
             if t.region is None :
                 t.region = r
                 t.hideregion = True
@@ -463,6 +827,7 @@ class LangTags(with_metaclass(Singleton, dict)):
             self.add(t)
 
     def add(self, tag) :
+        self.changed()          # merging changes tags in place
         allf = set(tag.allforms())
         merge = [a for a in allf if a in self]
         diff = allf - set(merge)
@@ -477,53 +842,192 @@ class LangTags(with_metaclass(Singleton, dict)):
             self[a] = tag
         return tag
 
+    def _lookupone(self, tag, tried):
+        """ Returns (form, LangTag) for tag, as given or normalised, or None. Adds what
+            it tries to tried. """
+        tried.append(tag)
+        if tag in self:
+            return (tag, self[tag])
+        try:
+            norm = repr(LangTag(tag))
+        except (TypeError, ValueError, IndexError):
+            return None
+        if norm != tag:
+            tried.append(norm)
+            if norm in self:
+                return (norm, self[norm])
+        return None
+
+    def lookup_many(self, tags, fallbacks=()) :
+        """ Looks up many tags at once. Each distinct tag is tried as given, then with its
+            separators and case normalised, then through each of fallbacks in turn until
+            one is found. A fallback is a dict of tag to the tag to try instead, or a
+            function that returns the tag to try instead, or None. Returns a dict of each
+            tag found to its TagMatch, and a list of a TagMiss for each tag not found, in
+            the order they were given. """
+        found = {}
+        misses = []
+        seen = set()
+        for tag in tags:
+            if tag in seen:
+                continue
+            seen.add(tag)
+            tried = []
+            res = self._lookupone(tag, tried)
+            fallback = None
+            if res is None:
+                for i, f in enumerate(fallbacks):
+                    alt = f.get(tag, None) if isinstance(f, dict) else f(tag)
+                    if alt is not None:
+                        res = self._lookupone(alt, tried)
+                        if res is not None:
+                            fallback = i
+                            break
+            if res is None:
+                misses.append(TagMiss(tag, tried))
+            else:
+                found[tag] = TagMatch(tag, res[0], str(res[1]), repr(res[1]), res[1], fallback)
+        return (found, misses)
+
     def generate_alltags(self) :
         res = []
         alltags = set(self.values())
-        for t in (x for x in sorted(alltags) if not x.skip):
+        for t in (x for x in sorted(alltags, key=repr) if not x.skip):     # as __lt__, but one repr each
             outs = t.allforms()
             # outs = sorted(t.allforms(), key = len)
             res.append(outs)
         return res
 
-if __name__ == '__main__' :
-    import sys
-
-    def find_file(tagstr, root='.') :
-        fname = tagstr.replace('-', '_') + '.xml'
-        testf = os.path.join(root, fname)
-        if os.path.exists(testf) : return testf
-        testf = os.path.join(root, fname[0], fname)
-        if os.path.exists(testf) : return testf
-        return None
+def sourcedigests(locales=(), extrasfile=None, iana=None, likely=None, supplemental=None):
+    """ Returns a dict of each language subtag to a digest of everything in the sources,
+        and the names of locales, that can change the lines of langtags.txt for it, in the
+        order they are read. Where two digests differ, the lines must be made again. """
+    entries = {}
+    def add(tag, entry):
+        entries.setdefault(_partition(tag), []).append(entry)
+    if iana is None :
+        iana = os.path.join(os.path.dirname(__file__), "language-subtag-registry.txt")
+    with open(iana, encoding="utf-8") as f :
+        for r in f.read().split("%%") :
+            fields = dict(l.split(": ", 1) for l in r.splitlines() if ": " in l and not l.startswith(" "))
+            if fields.get("Type") == "language" and "Subtag" in fields :
+                add(fields["Subtag"], r)
+            elif fields.get("Type") == "extlang" and "Prefix" in fields :
+                add(fields["Prefix"], r)
+    if likely is None :
+        likely = os.path.join(os.path.dirname(__file__), 'likelySubtags.xml')
+    for p in et.parse(likely).getroot().find('likelySubtags').findall('likelySubtag') :
+        add(p.get('to'), p.get('from') + " " + p.get('to'))
+    if extrasfile is not None :
+        with open(extrasfile, encoding="utf-8") as csvfile :
+            for row in csv.DictReader(csvfile, delimiter="\t") :
+                add(row['likely_subtag'], "\t".join(row[k] or "" for k in ('langtag', 'likely_subtag', 'confirmed')))
+    (scripts, regions) = _readsupplemental(supplemental)
+    for l, r in regions.items() :
+        add(l, repr((l, r, scripts.get(l, None))))
+    for l in sorted(locales) :
+        add(l, "locale " + l)
+    return {k: hashlib.sha256("\0".join(v).encode("utf-8")).hexdigest()[:32] for k, v in entries.items()}
 
-    indir = ['sldr']
-    if len(sys.argv) > 1 :
-        lts = LangTags(extrasfile=sys.argv[1])
-    else :
-        lts = LangTags()
+def alltagslines(lts, locales, findfile):
+    """ Returns the lines of langtags.txt for the tags in lts, and for any locales (the
+        names of the ldml files in an sldr) that aren't in it, with the tags findfile says
+        there is a file for marked. Only lines for the languages lts wants are made. """
     res = lts.generate_alltags()
-
-    alllocales = set()
-    for d in indir :
-        for l in os.listdir(d) :
-            if l.endswith('.xml') :
-                if 1 < len(l.split('_', 1)[0]) < 4 :
-                    alllocales.add(l[:-4])
-            elif os.path.isdir(os.path.join(d, l)) :
-                for s in os.listdir(os.path.join(d, l)) :
-                    if s.endswith('.xml') :
-                        if 1 < len(s.split('_', 1)[0]) < 4 :
-                            alllocales.add(s[:-4])
-    for l in alllocales :
+    for l in sorted(locales) :      # sorted, so that the output doesn't depend on hashing
+        if not (1 < len(l.split('_', 1)[0]) < 4) or not lts.wanted(l) :
+            continue
         t = LangTag(l)
         if str(t) not in lts :
             t = t.analyse(lts)
             lts.add(t)
             outs = sorted(t.allforms(), key = len)
             res.append(outs)
-    outstrings = []
-    for o in res :
-        outstrings.append(" = ".join(["*" + x if find_file(x, indir[0]) else x for x in o]))
-    print("\n".join(sorted(outstrings, key=lambda x:x.replace('*', ''))))
+    return [" = ".join(["*" + x if findfile(x) else x for x in o]) for o in res]
+
+def sortalltags(lines):
+    """ Sorts the lines of langtags.txt as they are written, ignoring the file marks """
+    return sorted(lines, key=lambda x:x.replace('*', ''))
+
+def updatealltags(previous, changed, lts, locales, findfile):
+    """ Returns the lines of langtags.txt made by replacing the lines in previous for the
+        languages in changed with those made from lts, which has just those languages. """
+    keep = [l for l in previous if _partition(l.lstrip("*").split(" ", 1)[0]) not in changed]
+    return sortalltags(keep + alltagslines(lts, locales, findfile))
 
+def _digestsname(lines):
+    key = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+    return os.path.join(LangTags.cachedir, 'langtags', key[:16] + '.digests')
+
+def readdigests(lines):
+    """ Returns the sourcedigests that the lines of langtags.txt were made from, if they
+        were kept in the cache when they were made, else None """
+    try:
+        with open(_digestsname(lines), encoding="utf-8") as inf:
+            return json.load(inf)
+    except (OSError, ValueError):
+        return None
+
+def writedigests(lines, digests):
+    """ Keeps the sourcedigests that lines were made from, for updating them later """
+    fname = _digestsname(lines)
+    d = os.path.dirname(fname)
+    try:
+        os.makedirs(d, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=d, delete=False, encoding="utf-8") as outf:
+            json.dump(digests, outf)
+        os.replace(outf.name, fname)
+    except OSError:
+        pass
+
+def makealltags(locales, findfile, extrasfile=None, previous=None, sources=None):
+    """ Returns the sorted lines of langtags.txt for locales, and the number of languages
+        made. Given the lines of a previous langtags.txt, made with digests in the cache,
+        only the languages whose sources or locales have changed are made again, and the
+        lines are the same as if all were. sources may give the iana, likely and
+        supplemental files to read. """
+    sources = sources or {}
+    digests = sourcedigests(locales, extrasfile, **sources)
+    olddigests = readdigests(previous) if previous is not None else None
+    if olddigests is None:
+        lts = LangTags.build(extrasfile=extrasfile, **sources)
+        res = sortalltags(alltagslines(lts, locales, findfile))
+        count = len(digests)
+    else:
+        changed = set(k for k in set(digests) | set(olddigests) if digests.get(k) != olddigests.get(k))
+        lts = LangTags.build(changed, extrasfile=extrasfile, **sources)
+        res = updatealltags(previous, changed, lts, locales, findfile)
+        count = len(changed)
+    writedigests(res, digests)
+    return (res, count)
+
+if __name__ == '__main__' :
+    import argparse, time
+
+    from sldr.ldml import localedir
+
+    parser = argparse.ArgumentParser(description="Makes langtags.txt from the IANA registry, "
+                                        "CLDR likely subtags and supplemental data, and an sldr")
+    parser.add_argument('extras', nargs='?', help='Tab separated file of extra likely subtags')
+    parser.add_argument('-i', '--indir', default='sldr', help='sldr directory [sldr]')
+    parser.add_argument('-p', '--previous', help='langtags.txt to update, remaking only the languages '
+                                        'whose sources have changed since it was made')
+    parser.add_argument('-o', '--output', help='File to write to, rather than stdout')
+    parser.add_argument('-t', '--timing', action='store_true', help='Report the time taken to stderr')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    ldir = localedir(args.indir)
+    findfile = lambda x: ldir.find(x.replace('-', '_'))
+    previous = None
+    if args.previous is not None :
+        with open(args.previous, encoding="utf-8") as inf :
+            previous = inf.read().splitlines()
+    (res, count) = makealltags(list(ldir), findfile, extrasfile=args.extras, previous=previous)
+    if args.output is not None :
+        with open(args.output, "w", encoding="utf-8") as outf :
+            outf.write("\n".join(res) + "\n")
+    else :
+        print("\n".join(res))
+    if args.timing :
+        sys.stderr.write("{} languages made in {:.3f}s\n".format(count, time.perf_counter() - start))
@@ -26,29 +26,156 @@
 from xml.etree import ElementTree as et
 from xml.etree import ElementPath as ep
 import itertools
-import re, os, codecs
+import re, os, io, codecs
 import xml.parsers.expat
 import functools
+import hashlib, pickle, tempfile
 from math import log10
 from .py3xmlparser import XMLParser, TreeBuilder
 
 
+def _scanfiles(root, ext):
+    """ Yields the paths of the files with the given extension under root """
+    try:
+        it = os.scandir(root)
+    except OSError:
+        return
+    with it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from _scanfiles(e.path, ext)
+            elif e.name.endswith(ext):
+                yield e.path
+
 def iterate_files(root, ext=".xml"):
     """ Iterate a directory and subdirectories finding files with given extension """
-    return sorted(functools.reduce(lambda a,x: a + x,
-            ([os.path.join(w[0], f) for f in w[2] if f.endswith(ext)]
-                    for w in os.walk(root)), []))
+    return sorted(_scanfiles(root, ext))
+
+class LocaleDir(object):
+    """ An index of the LDML files in a directory laid out as the SLDR is, with each
+        locale in root/xx.xml or root/x/xx.xml. The directory is read once, with
+        os.scandir, so finding a locale costs a dictionary lookup rather than probing
+        the file system. Call scan() to pick up files added or removed since. """
+
+    def __init__(self, root, ext=".xml"):
+        self.root = root
+        self.ext = ext
+        self.scan()
+
+    def _entries(self, d):
+        res = {}
+        subdirs = []
+        try:
+            it = os.scandir(d)
+        except OSError:
+            return (res, subdirs)
+        with it:
+            for e in it:
+                if e.name.endswith(self.ext):
+                    res[e.name[:-len(self.ext)]] = e.path
+                elif e.is_dir():
+                    subdirs.append(e)
+        return (res, subdirs)
+
+    def scan(self):
+        (self.top, subdirs) = self._entries(self.root)
+        self.subdirs = {e.name: self._entries(e.path)[0] for e in subdirs}
+
+    def find(self, lname, top=True, sub=True):
+        """ Returns the path of the file for lname, looking in root and then in the
+            subdirectory named by its lowercased first letter, or None """
+        if top and lname in self.top:
+            return self.top[lname]
+        if sub and len(lname):
+            return self.subdirs.get(lname[0].lower(), {}).get(lname, None)
+        return None
+
+    def items(self, top=True, sub=True):
+        """ Yields (locale, path) for each locale, the first found if there are several,
+            those in root first then those in subdirectories in sorted order """
+        seen = set()
+        groups = ([self.top] if top else []) + ([self.subdirs[k] for k in sorted(self.subdirs)] if sub else [])
+        for g in groups:
+            for k in sorted(g):
+                if k not in seen:
+                    seen.add(k)
+                    yield (k, g[k])
+
+    def __iter__(self):
+        return (k for k, v in self.items())
+
+    def __contains__(self, lname):
+        return self.find(lname) is not None
+
+_localedirs = {}
+def localedir(root, rescan=False):
+    """ Returns the shared LocaleDir for root, scanning it the first time it is asked
+        for, or again if rescan is set. """
+    key = os.path.abspath(root)
+    res = _localedirs.get(key, None)
+    if res is None:
+        res = _localedirs[key] = LocaleDir(root)
+    elif rescan:
+        res.scan()
+    return res
+
+def setlocaledir(ldir):
+    """ Makes ldir the shared LocaleDir for its root, e.g. to swap in a fresh scan that
+        was made while others were still looking things up in the old one """
+    _localedirs[os.path.abspath(ldir.root)] = ldir
+
+def filehash(*fnames):
+    """ Returns a hex digest of the contents of all the given files """
+    h = hashlib.sha256()
+    for f in fnames:
+        with open(f, 'rb') as inf:
+            h.update(inf.read())
+    return h.hexdigest()
+
+def savepickle(fname, data):
+    """ Atomically write data to a pickle file, so parallel readers only ever see a
+        complete file. Returns the size of the file. """
+    d = os.path.dirname(fname)
+    os.makedirs(d, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=d, delete=False) as outf:
+        pickle.dump(data, outf, protocol=pickle.HIGHEST_PROTOCOL)
+        size = outf.tell()
+    os.replace(outf.name, fname)
+    return size
 
 def getldml(loc, indirs):
     """ Given a langtag and list of root directories, seach for an LDML file and return the object """
-    for p in (".", loc[0].lower()):
+    lname = loc.replace("-", "_")
+    for top in (True, False):
         for i in indirs:
-            filep = os.path.join(i, p, loc.replace("-", "_")+".xml")
-            if os.path.exists(filep):
+            filep = localedir(i).find(lname, top=top, sub=not top)
+            if filep is not None:
                 return Ldml(filep)
     return None
     
 
+@functools.lru_cache(maxsize=1024)
+def parsepath(path):
+    """ Parses a path of tag[@attr="value"] steps, as taken by Ldml.ensure_path, into a tuple
+        of steps, each either a tag or a (tag, attributes dict) pair. Namespace prefixes are
+        left as they are. Results are cached and shared, so must not be changed. """
+    steps = []
+    for s in path.split("/"):
+        parts = re.split(r"\[(.*?)\]", s)
+        tag = parts.pop(0)
+        if not len(parts):
+            steps.append(tag)
+            continue
+        attrs = {}
+        for p in parts:
+            if not len(p): continue
+            (k, v) = re.split(r'\s*=\s*', p, maxsplit=1)
+            if k.startswith("@") and v[0] in '"\'':
+                attrs[k[1:]] = v[1:-1]
+        steps.append((tag, attrs))
+    return tuple(steps)
+    
+
 _elementprotect = {
     '&': '&amp;',
     '<': '&lt;',
@@ -56,6 +183,9 @@ _elementprotect = {
 _attribprotect = dict(_elementprotect)
 _attribprotect['"'] = '&quot;'
 _attribprotect["'"] = '&apos;'
+_elementtrans = str.maketrans(_elementprotect)
+_starttag = re.compile(rb'<[^\s/>]+(?:\s+[^\s=]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/?>')
+_attribtrans = str.maketrans(_attribprotect)
 
 _basenamespaces = {
     'urn://www.sil.org/ldml/0.1':           'sil',
@@ -88,6 +218,7 @@ class ETWriter(object):
     nscount = 0
     indent = "\t"
     maxAts = None
+    use_buffer = True
 
     def __init__(self, et, namespaces = None, attributeOrder = {}, takesCData = set()):
         self.root = et
@@ -132,13 +263,42 @@ class ETWriter(object):
             return self.attributeOrder.get(n.tag, {}).get(x, self.maxAts)
         return sorted((attribs if attribs is not None else n.keys()), key=lambda x:(getorder(x), x))
 
+    def _children(self, n):
+        ''' Returns the children of n to output, in order'''
+        return list(n)
+
+    def _rawxml(self, n, namespaces):
+        ''' Returns the text of a block that was not loaded, declaring any namespaces
+            it uses that are not in scope '''
+        if len(n) or n.text:
+            raise ValueError("Block {} was not loaded, so cannot be changed".format(n.tag))
+        res = n.rawxml
+        for q, u in n.rawdecls.items():
+            if namespaces.get(u, None) == q:
+                res = re.sub(r'\s+xmlns:{}\s*=\s*(["\']){}\1'.format(re.escape(q), re.escape(u)), '', res)
+        decls = "".join(' xmlns:{}="{}"'.format(q, u) for u, q in sorted(n.rawns.items(), key=lambda x:x[1])
+                            if u not in namespaces)
+        if not decls:
+            return res
+        i = 1 + len(re.match(r'[^\s/>]*', res[1:]).group(0))     # after the tag name
+        return res[:i] + decls + res[i:]
+
     def serialize_xml(self, write, base = None, indent = '', topns = True, namespaces = {}):
         """ Output the object using write() in a normalised way:
             topns if set puts all namespaces in root element else put them as low as possible"""
+        if self.use_buffer:
+            return self._serialize_buffered(write, base, indent, topns, namespaces)
         if base is None:
             base = self.root
             write('<?xml version="1.0" encoding="utf-8"?>\n')
             namespaces['http://www.w3.org/XML/1998/namespace'] = 'xml'
+        if getattr(base, 'rawxml', None) is not None:
+            for c in getattr(base, 'comments', []):
+                write('{}<!--{}-->\n'.format(indent, c))
+            write('{}{}\n'.format(indent, self._rawxml(base, namespaces)))
+            for c in getattr(base, 'commentsafter', []):
+                write('{}<!--{}-->\n'.format(indent, c))
+            return
         (tag, q, ns) = self._localisens(base.tag)
         localattribs = {}
         if ns and ns not in namespaces:
@@ -183,6 +343,103 @@ class ETWriter(object):
         for c in getattr(base, 'commentsafter', []):
             write('{}<!--{}-->\n'.format(indent, c))
 
+    def _serialize_buffered(self, write, base, indent, topns, namespaces):
+        ''' Does the work of serialize_xml, producing identical output. The whole
+            document is collected into a list of strings and written with a single call. '''
+        out = []
+        add = out.append
+        if base is None:
+            base = self.root
+            add('<?xml version="1.0" encoding="utf-8"?>\n')
+            namespaces['http://www.w3.org/XML/1998/namespace'] = 'xml'
+        names = {}
+        orders = {}
+        takesCData = self.takesCData
+        children = self._children
+        step = self.indent
+
+        def localise(tag):
+            # Unknown namespaces are numbered on each use, so only cache known ones
+            res = names.get(tag, None)
+            if res is None:
+                res = self._localisens(tag)
+                if res[2] is None or res[2] in self.namespaces:
+                    names[tag] = res
+            return res
+
+        def sortedattrs(n, localattribs):
+            k = (n.tag, tuple(localattribs))
+            res = orders.get(k, None)
+            if res is None:
+                res = self._sortedattrs(n, localattribs)
+                orders[k] = res
+            return res
+
+        def donode(n, indent, scope, owned):
+            if getattr(n, 'rawxml', None) is not None:
+                for c in getattr(n, 'comments', []):
+                    add(indent + '<!--' + c + '-->\n')
+                add(indent + self._rawxml(n, scope) + '\n')
+                for c in getattr(n, 'commentsafter', []):
+                    add(indent + '<!--' + c + '-->\n')
+                return
+            kids = children(n)
+            (tag, q, ns) = localise(n.tag)
+            localattribs = {}
+            # scope is shared with the parent until this element needs to add to it
+            if ns and ns not in scope:
+                if not owned: scope = dict(scope); owned = True
+                scope[ns] = q
+                localattribs['xmlns:'+q] = ns
+            if topns:
+                if n is self.root:
+                    for u, p in self.namespaces.items():
+                        if p == "xml": continue
+                        if not owned: scope = dict(scope); owned = True
+                        localattribs['xmlns:'+p] = u
+                        scope[u] = p
+            else:
+                for c in kids:
+                    (lt, lq, lns) = localise(c.tag)
+                    if lns and lns not in scope:
+                        if not owned: scope = dict(scope); owned = True
+                        scope[lns] = q
+                        localattribs['xmlns:'+lq] = lns
+            attribs = getattr(n, 'attrib', None)
+            if attribs is not None:
+                for k, v in attribs.items():
+                    (lt, lq, lns) = localise(k)
+                    if lns and lns not in scope:
+                        if not owned: scope = dict(scope); owned = True
+                        scope[lns] = lq
+                        localattribs['xmlns:'+lq] = lns
+                    localattribs[lt] = v
+            for c in getattr(n, 'comments', []):
+                add(indent + '<!--' + c + '-->\n')
+            add(indent + '<' + tag)
+            if localattribs:
+                for k in sortedattrs(n, localattribs):
+                    add(' ' + k + '="' + localattribs[k].translate(_attribtrans) + '"')
+            if kids:
+                add('>\n')
+                subindent = indent + step
+                for b in kids:
+                    donode(b, subindent, scope, False)
+                add(indent + '</' + tag + '>\n')
+            elif n.text:
+                if tag not in takesCData:
+                    t = n.text.replace('\n', '\n' + indent).translate(_elementtrans)
+                else:
+                    t = "<![CDATA[\n\t" + indent + n.text.replace('\n', '\n\t' + indent) + "\n" + indent + "]]>"
+                add('>' + t + '</' + tag + '>\n')
+            else:
+                add('/>\n')
+            for c in getattr(n, 'commentsafter', []):
+                add(indent + '<!--' + c + '-->\n')
+
+        donode(base, indent, namespaces, True)
+        write("".join(out))
+
     def save_as(self, fname, base = None, indent = '', topns = True, namespaces = {}):
         """ A more comfortable serialize_xml using a filename"""
         with codecs.open(fname, "w", encoding="utf-8") as outf:
@@ -198,7 +455,9 @@ class ETWriter(object):
         """ Appends a new node to a parent, returning the new node.
             Empty (None) attributes are stripped"""
         kw = {k: v for k, v in kw.items() if v is not None}
-        return et.SubElement(parent, tag, **kw)
+        res = parent.makeelement(tag, kw)      # not et.SubElement, which makes a plain Element
+        parent.append(res)
+        return res
 
     def _reverselocalns(self, tag):
         ''' Convert ns:tag -> {url}tag'''
@@ -227,58 +486,286 @@ def etwrite(et, write, topns = True, namespaces = None):
 _alldrafts = ('approved', 'contributed', 'provisional', 'unconfirmed', 'tentative', 'generated', 'suspect')
 draftratings = {v:i for i,v in enumerate(_alldrafts)}
 
-class _minhash(object):
-    ''' Hash class that can hash vectors. Also supports minimal hashing with hamming distance.'''
-    _maxbits = 56
-    _bits = 4
-    _mask = 0xFFFFFFFFFFFFFFFF
-
-    def __init__(self, hasher = hash, nominhash = True):
-        self.minhash = None if nominhash else (1 << self._maxbits) - 1
-        self.hashed = 0
-        self.hasher = hasher
-
-    def __eq__(self, other):
-        return self.hashed == other.hashed and self.minhash == other.minhash
-
-    def __repr__(self):
-        return "<{} {:0X}>".format(type(self), self.hashed)
-
-    def __hash__(self):
-        return self.hashed
-
-    def update(self, *vec):
-        h = [self.hasher(x) for x in vec]
-        if self.minhash is not None:
-            for x in h: self._minhashupdate(h)
-        self.hashed = functools.reduce(lambda x,y:x * 1000003 + y, h, self.hashed) & self._mask
-
-    def merge(self, aminh):
-        if self.minhash is not None and aminh.minhash is not None: self._minhashupdate(aminh.minhash)
-        self.hashed = (self.hashed * 1000003 + aminh.hashed) & self._mask
-
-    def _minhashupdate(self, ahash):
-        x = (1 << self._bits) - 1
-        for i in range(self._maxbits / self._bits):
-            if (ahash & x) < (self.minhash & x):
-                self.minhash = (self.minhash & ~x) | (ahash & x)
-            x <<= self._bits
-
-    def hamming(self, amin):
-        x = (1 << self._bits) - 1
-        res = 0
-        for i in range(self._maxbits / self._bits):
-            if (self.minhash & x) != (amin & x): res += 1
-            x <<= self._bits
+_stablekey = b'sldr._minhash'
+
+@functools.lru_cache(maxsize=1<<16)
+def stablehash(txt):
+    """ A keyed 64 bit hash of a string that, unlike hash(), is the same in every process """
+    return int.from_bytes(hashlib.blake2b(txt.encode('utf-8'), digest_size=8, key=_stablekey).digest(), 'little')
+
+_normtokens = {}
+_hashmask = 0xFFFFFFFFFFFFFFFF
+
+class LdmlElement(et.Element):
+    """ C implemented Element that, unlike et.Element, can carry the parent, document,
+        comments, etc. attributes that Ldml hangs off its nodes. The C builtins create
+        plain Elements, so keep copies and new children in this class. """
+
+    def makeelement(self, tag, attrib):
+        return self.__class__(tag, attrib)
+
+    def copy(self):
+        res = self.makeelement(self.tag, self.attrib)
+        res.text = self.text
+        res.tail = self.tail
+        res[:] = self
+        return res
+
+    __copy__ = copy
+
+
+class _ChildIndex(object):
+    """ Element mixin that indexes its children by tag, and by tag and attribute value,
+        so that path lookups need only look at the children that might match. The index
+        is built on first use and dropped whenever the children change or one of them
+        has an attribute set(). The C et.SubElement adds children without calling append,
+        so the index also keeps the number of children it was made from, and is made
+        again if that has changed. draft and alt are changed in place through .attrib, so
+        they are never indexed on. """
+
+    __slots__ = ()
+    _tagindex = None
+
+    def children_by_tag(self, tag, attrs=None):
+        ''' Returns, in document order, the children with the given tag that might match
+            the given attributes. The attributes still need checking. '''
+        cached = getattr(self, '_tagindex', None)
+        if cached is None or cached[0] != len(self):
+            idx = {}
+            for c in self:
+                idx.setdefault(c.tag, []).append(c)
+            self._tagindex = (len(self), idx)
+        else:
+            idx = cached[1]
+        if attrs:
+            for k in attrs:
+                if k != 'draft' and k != 'alt':
+                    break
+            else:
+                return idx.get(tag, ())
+            vals = idx.get((tag, k), None)
+            if vals is None:
+                vals = {}
+                for c in idx.get(tag, ()):
+                    vals.setdefault(c.get(k, ''), []).append(c)
+                idx[(tag, k)] = vals
+            return vals.get(attrs[k], ())
+        return idx.get(tag, ())
+
+    def set(self, key, value):
+        parent = getattr(self, 'parent', None)
+        if parent is not None:
+            parent._tagindex = None
+        super(_ChildIndex, self).set(key, value)
+
+    def append(self, e):
+        self._tagindex = None
+        super(_ChildIndex, self).append(e)
+
+    def extend(self, elements):
+        self._tagindex = None
+        super(_ChildIndex, self).extend(elements)
+
+    def insert(self, index, e):
+        self._tagindex = None
+        super(_ChildIndex, self).insert(index, e)
+
+    def remove(self, e):
+        self._tagindex = None
+        super(_ChildIndex, self).remove(e)
+
+    def clear(self):
+        self._tagindex = None
+        super(_ChildIndex, self).clear()
+
+    def __setitem__(self, index, e):
+        self._tagindex = None
+        super(_ChildIndex, self).__setitem__(index, e)
+
+    def __delitem__(self, index):
+        self._tagindex = None
+        super(_ChildIndex, self).__delitem__(index)
+
+
+_PyElement = getattr(et, '_Element_Py', et.Element)
+
+class IndexedElement(_ChildIndex, _PyElement):
+    """ Python implemented Element with a child index """
+    pass
+
+class IndexedLdmlElement(_ChildIndex, LdmlElement):
+    """ LdmlElement with a child index """
+    pass
+
+class CompactElement(et.Element):
+    """ et.Element with slots for the attributes Ldml and LdmlMerge hang off their nodes,
+        rather than a dict per node, that reuses LdmlElement's makeelement and copy. Any
+        other attribute still works, in a dict that is only made for the nodes that need
+        one. """
+    __slots__ = ('parent', 'document', 'contentHash', 'attrHash', 'alternates', 'comments',
+                 'commentsafter', 'hasdeletedchild', 'normstate', 'mergeOther', 'mergeBase',
+                 'tempnode', '__dict__')
+
+    makeelement = LdmlElement.makeelement
+    copy = LdmlElement.copy
+    __copy__ = copy
+
+class IndexedCompactElement(_ChildIndex, CompactElement):
+    """ CompactElement with a child index """
+    __slots__ = ('_tagindex',)
+
+
+def _commenttext(text):
+    return text
+
+
+class SnapshotCache(object):
+    """ A size limited directory of pickled, normalised, Ldml trees, keyed by the contents
+        of the file they were read from. The least recently used are evicted first. """
+
+    def __init__(self, cachedir, maxsize=256<<20):
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key + ".pickle")
+
+    def get(self, key):
+        """ Returns the snapshot stored under key or None """
+        fname = self._path(key)
+        try:
+            with open(fname, 'rb') as inf:
+                res = pickle.load(inf)
+            os.utime(fname)             # mark as recently used
+        except Exception:               # missing, unreadable or just evicted
+            self.misses += 1
+            return None
+        self.hits += 1
+        return res
+
+    def put(self, key, snapshot):
+        """ Stores a snapshot, evicting old ones if the cache gets too big """
+        try:
+            size = savepickle(self._path(key), snapshot)
+        except OSError:
+            return
+        self.stores += 1
+        if self._size is None:
+            self._size = sum(x[1] for x in self._entries())
+        else:
+            self._size += size
+        if self._size > self.maxsize:
+            self.evict()
+
+    def _entries(self):
+        """ Returns a list of (mtime, size, path) for each snapshot """
+        res = []
+        try:
+            with os.scandir(self.cachedir) as it:
+                for e in it:
+                    if e.name.endswith(".pickle"):
+                        try:
+                            st = e.stat()
+                        except OSError:
+                            continue
+                        res.append((st.st_mtime, st.st_size, e.path))
+        except OSError:
+            pass
         return res
 
+    def evict(self, maxsize=None):
+        """ Removes the least recently used snapshots until the cache is comfortably
+            within maxsize (defaulting to self.maxsize) """
+        if maxsize is None:
+            maxsize = self.maxsize
+        entries = sorted(self._entries())
+        self._size = sum(x[1] for x in entries)
+        for (t, size, path) in entries:
+            if self._size <= maxsize * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._size -= size
+            self.evictions += 1
+
+    def clear(self):
+        self.evict(0)
+
+    def stats(self):
+        """ Returns a dict of usage counts for this process and the current size of the cache """
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores,
+                'evictions': self.evictions, 'files': len(entries),
+                'size': sum(x[1] for x in entries), 'maxsize': self.maxsize}
+
+    def report(self):
+        s = self.stats()
+        lookups = s['hits'] + s['misses']
+        return "{hits} hits, {misses} misses ({0:.1f}% hit rate), {stores} stored, {evictions} evicted; " \
+               "{files} snapshots using {1:.1f}MB of {2:.1f}MB".format(
+                    100. * s['hits'] / lookups if lookups else 0., s['size'] / 1048576.,
+                    s['maxsize'] / 1048576., **s)
+
 
 class Ldml(ETWriter):
     silns = "urn://www.sil.org/ldml/0.1"
     takesCData = set(('cr','sil:note', 'sil:text'))
     use_draft = None
+    use_cparser = False         # build trees of LdmlElement using the C parser
+    use_childindex = False      # index children by tag for faster path lookups
+    use_compactnodes = False    # build trees of CompactElement, whatever the parser
     nonkeyContexts = {}         # cls.nonkeyContexts[element] = set(attributes)
     keyContexts = {}            # cls.keyContexts[element] = set(attributes)
+    # opt in to caching the metadata, and identity indexes, by setting this or $SLDR_CACHE to a directory
+    cachedir = os.environ.get('SLDR_CACHE', '') or None
+    _metadataversion = 1
+    _snapshotversion = 1
+    # opt in to caching parsed files by setting this to a SnapshotCache, or $SLDR_SNAPSHOTS to a size in MB
+    snapshots = SnapshotCache(os.path.join(cachedir or os.path.join(os.path.expanduser('~'), '.cache', 'sldr'),
+                                           'snapshots'), int(os.environ['SLDR_SNAPSHOTS']) << 20) \
+                    if os.environ.get('SLDR_SNAPSHOTS', '') else None
+    # make contentHash and attrHash the same across processes. Snapshots are only used with this
+    use_stablehash = snapshots is not None
+    _metadataattrs = ('elementCount', 'attributeOrder', 'elementOrder', 'attribvals', 'maxEls', 'maxAts',
+                      'blocks', 'variables', 'serialElements', 'keys', 'keyContexts', 'nonkeyContexts')
+
+    @classmethod
+    def LoadMetadata(cls, fname = None):
+        """ Sets up the same information as ReadMetadata, from a compiled cache in cachedir, if
+            one is set, when that was made from source files with the same contents. Call this
+            before creating a process Pool so that the workers inherit the results rather than
+            each reading them again."""
+        if fname is None:
+            fname = os.path.join(os.path.dirname(__file__), 'supplementalMetadata.xml')
+        key = (cls._metadataversion, filehash(fname, os.path.join(os.path.dirname(__file__), 'sil.dtd'),
+                                              os.path.join(os.path.dirname(__file__), 'tzones.csv')))
+        cls.metadatakey = key[1]
+        if not cls.cachedir:
+            cls.ReadMetadata(fname)
+            return
+        cachef = os.path.join(cls.cachedir, 'ldmlmetadata.pickle')
+        try:
+            with open(cachef, 'rb') as inf:
+                (cachekey, data) = pickle.load(inf)
+            if cachekey == key:
+                for k, v in data.items():
+                    setattr(cls, k, v)
+                return
+        except Exception:       # missing or unreadable, so rebuild it
+            pass
+        cls.ReadMetadata(fname)
+        data = {k: getattr(cls, k) for k in cls._metadataattrs}
+        try:
+            savepickle(cachef, (key, data))
+        except OSError:
+            pass
 
     @classmethod
     def ReadMetadata(cls, fname = None):
@@ -411,18 +898,22 @@ class Ldml(ETWriter):
         ndig = "{{:0{}d}}".format(int(log10(len(vals)) + 1.))
         cls.attribvals.setdefault('zone', {})['type'] = {v:ndig.format(i+1) for i,v in enumerate(vals)}
 
-    def __init__(self, fname, usedrafts=True, uparrows=False):
+    def __init__(self, fname, usedrafts=True, uparrows=False, cparser=None, blocks=None):
+        """ Reads an LDML file, or file object. If blocks is given, only those top level
+            elements (e.g. ['identity', 'characters']) are read. The others are kept as
+            text and written back out as they were. """
         if not hasattr(self, 'elementOrder'):
-            self.__class__.ReadMetadata()
+            self.__class__.LoadMetadata()
         self.namespaces = {'http://www.w3.org/XML/1998/namespace': 'xml'}
         self.namespaces[self.silns] = 'sil'
         self.useDrafts = usedrafts
-        curr = None
-        comments = []
+        if cparser is None:
+            cparser = self.use_cparser
+        snapkey = None
 
         if fname is None or isinstance(fname, str):
             if fname is None or not os.path.exists(fname) or not os.path.getsize(fname):
-                self.root = getattr(et, '_Element_Py', et.Element)('ldml')
+                self.root = self._elementclass(cparser)('ldml')
                 self.root.document = self
                 self.default_draft = 'unconfirmed'
                 self._analyse()
@@ -431,21 +922,189 @@ class Ldml(ETWriter):
             else:
                 self.fname = fname
                 fh = open(self.fname, 'rb')     # expat does utf-8 decoding itself. Don't do it twice
+                if blocks is None and self.snapshots is not None and self.use_stablehash \
+                        and getattr(self, 'metadatakey', None) is not None:
+                    data = fh.read()
+                    fh.close()
+                    snapkey = self._snapshotkey(data, usedrafts, uparrows)
+                    snap = self.snapshots.get(snapkey)
+                    if snap is not None and snap['version'] == self._snapshotversion:
+                        self._fromsnapshot(snap, cparser=cparser)
+                        self._analyse()
+                        return
+                    fh = io.BytesIO(data)
         else:
             fh = fname
-        if hasattr(et, '_Element_Py'):
-            tb = TreeBuilder(element_factory=et._Element_Py)
+        skipped = None
+        if blocks is not None:
+            data = fh.read()
+            fh.close()
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            (data, skipped) = self._selectblocks(data, blocks)
+            fh = io.BytesIO(data)
+        self._parse(fh, uparrows=uparrows, cparser=cparser)
+        fh.close()
+        if skipped is not None:
+            self._addskipped(skipped)
+        self._analyse()
+        self.normalise(self.root, usedrafts=usedrafts)
+        if snapkey is not None:
+            self.snapshots.put(snapkey, self._snapshot())
+
+    def _selectblocks(self, data, blocks):
+        """ Scans the XML in data for its top level elements and returns the XML without
+            those not in blocks, and a list of (index, tag, text, comments, namespaces used,
+            namespaces declared) for the ones taken out. """
+        blocks = set(blocks)
+        parser = xml.parsers.expat.ParserCreate()
+        tops = []
+        rootns = {}
+        state = {'depth': 0, 'rootend': 0, 'curr': None, 'comments': []}
+        def start(name, attrs):
+            state['depth'] += 1
+            depth = state['depth']
+            if depth == 1:
+                state['rootend'] = _starttag.match(data, parser.CurrentByteIndex).end()
+                rootns.update((k[6:], v) for k, v in attrs.items() if k.startswith('xmlns:'))
+                return
+            elif depth == 2:
+                # [tag, start, end, comments, prefixes used, {prefix: url} declared]
+                state['curr'] = [name, parser.CurrentByteIndex, None, state['comments'], set(), {}]
+                state['comments'] = []
+            curr = state['curr']
+            for n in itertools.chain((name,), attrs.keys()):
+                if n.startswith('xmlns:'):
+                    curr[5][n[6:]] = attrs[n]
+                elif ':' in n:
+                    curr[4].add(n[:n.index(':')])
+        def end(name):
+            if state['depth'] == 2:
+                curr = state['curr']
+                i = parser.CurrentByteIndex
+                if data.startswith(b'</' + name.encode("utf-8"), i):
+                    curr[2] = data.index(b'>', i) + 1
+                elif i == curr[1]:      # <empty/>, reported at its start
+                    curr[2] = _starttag.match(data, i).end()
+                else:                   # <empty/>, reported after its end
+                    curr[2] = i
+                tops.append(curr)
+            state['depth'] -= 1
+        def comment(text):
+            if state['depth'] == 1:
+                state['comments'].append(text)
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CommentHandler = comment
+        parser.Parse(data, True)
+        prev = state['rootend']
+        res = [data[:prev]]
+        skipped = []
+        for i, (tag, begin, end, comments, used, declared) in enumerate(tops):
+            if tag in blocks:
+                res.append(data[prev:end])
+            else:
+                skipped.append((i, tag, data[begin:end].decode("utf-8"), comments,
+                                {rootns[q]: q for q in used - set(declared) if q in rootns}, declared))
+            prev = end
+        res.append(data[prev:])
+        return (b"".join(res), skipped)
+
+    def _addskipped(self, skipped):
+        """ Puts placeholders for the skipped top level elements back in the tree """
+        self.skipped = []
+        for (i, tag, text, comments, ns, decls) in skipped:
+            e = self.root.makeelement(self._reverselocalns(tag), {})
+            e.rawxml = text
+            e.rawns = ns
+            e.rawdecls = decls
+            e.document = self
+            e.parent = self.root
+            if len(comments):
+                e.comments = comments
+            self.root.insert(i, e)
+            self.skipped.append(e.tag)
+
+    def _snapshotkey(self, data, usedrafts, uparrows):
+        h = hashlib.sha256(data)
+        h.update("{} {} {} {}".format(self._snapshotversion, self.metadatakey, usedrafts, uparrows).encode("utf-8"))
+        return h.hexdigest()
+
+    def _snapshot(self):
+        """ Returns the tree, as normalised, in a compact picklable form """
+        done = {}           # serial elements can be both children and alternates
+        def snapnode(e):
+            if id(e) in done:
+                return done[id(e)]
+            h = (e.contentHash, e.attrHash) if hasattr(e, 'contentHash') else None
+            alts = getattr(e, 'alternates', None)
+            res = (e.tag, dict(e.attrib) or None, e.text, getattr(e, 'comments', None),
+                    getattr(e, 'commentsafter', None), h, [snapnode(c) for c in e] or None,
+                    {k: snapnode(v) for k, v in alts.items()} if alts is not None else None)
+            done[id(e)] = res
+            return res
+        return {'version': self._snapshotversion, 'namespaces': self.namespaces, 'root': snapnode(self.root)}
+
+    def _fromsnapshot(self, snap, cparser=False):
+        """ Rebuilds the tree, with its (stable) hashes, from a snapshot """
+        factory = self._elementclass(cparser)
+        done = {}
+        def mknode(s, parent):
+            if id(s) in done:
+                return done[id(s)]
+            (tag, attrib, text, comments, commentsafter, hashes, children, alts) = s
+            e = factory(tag, attrib or {})
+            done[id(s)] = e
+            e.text = text
+            e.document = self
+            if parent is not None:
+                e.parent = parent
+            if comments is not None:
+                e.comments = comments
+            if commentsafter is not None:
+                e.commentsafter = commentsafter
+            if children is not None:
+                e.extend([mknode(c, e) for c in children])
+            if alts is not None:
+                e.alternates = {k: mknode(v, parent) for k, v in alts.items()}
+            if hashes is not None:
+                (e.contentHash, e.attrHash) = hashes
+            return e
+        self.namespaces.update(snap['namespaces'])
+        self.root = mknode(snap['root'], None)
+
+    @classmethod
+    def _elementclass(cls, cparser=False):
+        """ Returns the class of the nodes in the tree """
+        if cls.use_compactnodes:
+            return IndexedCompactElement if cls.use_childindex else CompactElement
+        if cls.use_childindex:
+            return IndexedLdmlElement if cparser else IndexedElement
+        return LdmlElement if cparser else _PyElement
+
+    def _parse(self, fh, uparrows=False, cparser=False):
+        """ Read the tree from fh into self.root, hanging parent, document and comments off the nodes """
+        curr = None
+        comments = []
+        if cparser:
+            # comments come through as their text, via a comment event
+            tb = et.TreeBuilder(element_factory=self._elementclass(cparser), comment_factory=_commenttext)
+            parser = et.XMLParser(target=tb, encoding="UTF-8")
+            events = ('start', 'start-ns', 'end', 'comment')
         else:
-            tb = TreeBuilder()
-        parser = XMLParser(target=tb, encoding="UTF-8")
-        def doComment(data):
-            # resubmit as new start tag=!-- and sort out in main loop
-            parser.parser.StartElementHandler("!--", ('text', data))
-            parser.parser.EndElementHandler("!--")
-        parser.parser.CommentHandler = doComment
-        for event, elem in et.iterparse(fh, events=('start', 'start-ns', 'end'), parser=parser):
+            tb = TreeBuilder(element_factory=self._elementclass(cparser))
+            parser = XMLParser(target=tb, encoding="UTF-8")
+            def doComment(data):
+                # resubmit as new start tag=!-- and sort out in main loop
+                parser.parser.StartElementHandler("!--", ('text', data))
+                parser.parser.EndElementHandler("!--")
+            parser.parser.CommentHandler = doComment
+            events = ('start', 'start-ns', 'end')
+        for event, elem in et.iterparse(fh, events=events, parser=parser):
             if event == 'start-ns':
                 self.namespaces[elem[1]] = elem[0]
+            elif event == 'comment':
+                comments.append(elem)
             elif event == 'start':
                 elem.document = self
                 if elem.tag == '!--':
@@ -474,9 +1133,6 @@ class Ldml(ETWriter):
                         curr.hasdeletedchild = True
                     elif curr is not None:
                         curr.hasdeletedchild = False
-        fh.close()
-        self._analyse()
-        self.normalise(self.root, usedrafts=usedrafts)
 
     def _copynode(self, n, parent=None):
         res = n.copy()
@@ -487,6 +1143,34 @@ class Ldml(ETWriter):
             res.parent = parent
         return res
 
+    def _copysubtree(self, n, parent=None, _memo=None):
+        """ Returns a deep copy of n, its children and their alternates, for use in this
+            document. Elements that are shared, such as serial elements that are also an
+            alternate, are copied once. """
+        if _memo is None:
+            _memo = {}
+        res = _memo.get(id(n), None)
+        if res is not None:
+            return res
+        res = n.makeelement(n.tag, n.attrib)
+        _memo[id(n)] = res
+        res.text = n.text
+        res.tail = n.tail
+        for a in ('contentHash', 'attrHash'):
+            if hasattr(n, a):
+                setattr(res, a, getattr(n, a))
+        for a in ('comments', 'commentsafter'):
+            if hasattr(n, a):
+                setattr(res, a, list(getattr(n, a)))
+        if parent is not None:
+            res.parent = parent
+        res.document = self
+        res.extend([self._copysubtree(c, res, _memo) for c in n])
+        alts = getattr(n, 'alternates', None)
+        if alts is not None:
+            res.alternates = {k: self._copysubtree(v, parent, _memo) for k, v in alts.items()}
+        return res
+
     def addnode(self, parent, tag, attrib=None, alt=None, returnnew=False, **attribs):
         ''' Adds a node, keeping the best alternate at the front '''
         if attrib is not None:
@@ -632,7 +1316,8 @@ class Ldml(ETWriter):
                 newcurr = curr
             else:
                 for job in curr:
-                    for c in job:
+                    bytag = getattr(job, 'children_by_tag', None)
+                    for c in (bytag(tag, attrs) if bytag is not None else job):
                         if c.tag != tag:
                             continue
                         for k, v in attrs.items():
@@ -672,21 +1357,10 @@ class Ldml(ETWriter):
         draft = self.use_draft if draft is None else draft
         if path.startswith("/"):
             raise SyntaxError
-        steps = []
-        for s in path.split("/"):
-            parts = re.split(r"\[(.*?)\]", s)
-            tag = parts.pop(0)
-            tag = self._reverselocalns(tag)
-            if not len(parts):
-                steps.append(tag)
-                continue
-            attrs = {}
-            for p in parts:
-                if not len(p): continue
-                (k, v) = re.split(r'\s*=\s*', p, maxsplit=1)
-                if k.startswith("@") and v[0] in '"\'':
-                    attrs[self._reverselocalns(k[1:])] = v[1:-1]
-            steps.append((tag, attrs))
+        steps = parsepath(path)
+        if ":" in path:
+            steps = [self._reverselocalns(s) if isinstance(s, str) else (self._reverselocalns(s[0]),
+                        {self._reverselocalns(k): v for k, v in s[1].items()}) for s in steps]
         res = self._unify_path(steps, base=base, action=action, text=text, draft=draft, alt=alt, matchdraft=matchdraft, before=before)
         return (res, steps)
 
@@ -750,14 +1424,25 @@ class Ldml(ETWriter):
         else:
             return []
 
-    def normalise(self, base=None, addguids=True, usedrafts=False):
-        """ Normalise according to LDML rules"""
+    def normalise(self, base=None, addguids=True, usedrafts=False, full=False):
+        """ Normalise according to LDML rules. Elements that have not changed since they were
+            last normalised are not redone, unless full is set, if that last time was with the
+            same usedrafts and addguids. Only the latest state is kept, so alternating between
+            settings redoes everything. Returns True if base was left as it was. """
         _digits = set('0123456789.')
         if base is None:
             base = self.root
+        token = (usedrafts, usedrafts or addguids, self.use_stablehash)
+        token = _normtokens.setdefault(token, token)    # one shared copy for every node
+        unchanged = not full
         if len(base):
             for b in base:
-                self.normalise(b, addguids=addguids, usedrafts=usedrafts)
+                if not self.normalise(b, addguids=addguids, usedrafts=usedrafts, full=full):
+                    unchanged = False
+        if unchanged and self._isnormalised(base, token, usedrafts):
+            return True
+        packed = False
+        if len(base):
             def getorder(x):
                 return self.attributeOrder.get(base.tag, {}).get(x, self.maxAts)
             def cmpat(x, y):
@@ -803,6 +1488,38 @@ class Ldml(ETWriter):
                 a = c.get('alt', None)
                 if a not in temp[c.attrHash] or id(temp[c.attrHash][a]) != id(c):
                     base.remove(c)
+                    packed = True
+        if not packed:
+            self._setnormalised(base, token, usedrafts)
+        return False
+
+    def _setnormalised(self, base, token, usedrafts):
+        """ Records what a normalised element looks like, so that normalise can tell whether
+            it has changed since. An element with alternates among its children is not
+            recorded, since normalising it again with usedrafts repacks its alternates. Nor is
+            one that lost children to its alternates, since its hashes include them. """
+        if usedrafts and any(getattr(c, 'alternates', None) for c in base):
+            return
+        # only the latest state is kept, not one per token, to keep the cost per node down
+        attrib = dict(base.attrib) if len(base.attrib) else None
+        if token[1]:
+            base.normstate = (token, base.text, attrib, tuple(base), base.contentHash, base.attrHash)
+        else:
+            base.normstate = (token, base.text, attrib, tuple(base), None, None)
+
+    def _isnormalised(self, base, token, usedrafts):
+        """ Returns whether base, whose children are all unchanged, is as it was when last
+            normalised in this way, restoring the hashes it had then. """
+        s = getattr(base, 'normstate', None)
+        if s is None or s[0] is not token or base.tail is not None or s[1] != base.text \
+                or (s[2] or {}) != base.attrib or s[3] != tuple(base):
+            return False
+        if usedrafts and any(getattr(c, 'alternates', None) for c in base):
+            return False
+        if token[1]:
+            base.contentHash = s[4]
+            base.attrHash = s[5]
+        return True
 
     def _analyse(self):
         """ Pull out key information from the ldml for its processing."""
@@ -826,11 +1543,16 @@ class Ldml(ETWriter):
         return distkeys
 
     def _calc_hashes(self, base, usedrafts=False):
-        ''' Calculate content and attribute hashes for this node and all children '''
-        base.contentHash = _minhash(nominhash = True)
+        ''' Calculate content and attribute hashes for this node and all children. The hashes
+            are plain 64 bit ints, each folded into the next as x * 1000003 + y. '''
+        hasher = stablehash if self.use_stablehash else hash
+        mask = _hashmask
+        content = 0
         for b in base:
-            base.contentHash.merge(b.contentHash)
-        if base.text: base.contentHash.update(*(base.text.split("\n")))
+            content = (content * 1000003 + b.contentHash) & mask
+        if base.text:
+            for x in base.text.split("\n"):
+                content = (content * 1000003 + hasher(x)) & mask
         distkeys = set(self.keys)
         if base.tag in self.nonkeyContexts:
             distkeys -= self.nonkeyContexts[base.tag]
@@ -838,18 +1560,18 @@ class Ldml(ETWriter):
             distkeys |= self.keyContexts[base.tag]
         if usedrafts:
             distkeys.discard('draft')
-        base.attrHash = _minhash(nominhash = True)
-        base.attrHash.update(base.tag)                      # keying hash has tag
+        attr = hasher(base.tag) & mask                      # keying hash has tag
         for k, v in sorted(base.items()):                      # any consistent order is fine
             if usedrafts and k == 'alt': # and v.find("proposed") != -1:
-                val = v # re.sub(r"-?proposed.*$", "", v)
-                if False and len(val):
-                    base.attrHash.update(k, val)
+                pass
             elif k in distkeys:
-                base.attrHash.update(k, v)        # keying hash has key attributes
+                attr = (attr * 1000003 + hasher(k)) & mask        # keying hash has key attributes
+                attr = (attr * 1000003 + hasher(v)) & mask
             elif not usedrafts or (k != 'draft' and k != 'alt' and k != '{'+self.silns+'}alias'):
-                base.contentHash.update(k, v)     # content hash has non key attributes
-        base.contentHash.merge(base.attrHash)               #   and keying hash
+                content = (content * 1000003 + hasher(k)) & mask  # content hash has non key attributes
+                content = (content * 1000003 + hasher(v)) & mask
+        base.attrHash = attr
+        base.contentHash = (content * 1000003 + attr) & mask   #   and keying hash
 
     def as_xpath(self, n, usedrafts=False):
         """ Return an xpath description for this element """
@@ -871,6 +1593,8 @@ class Ldml(ETWriter):
             self.use_draft = None
             self.ensure_path('identity/special/sil:identity[@uid="{}"]'.format(self.uid))
             self.use_draft = dstatus
+        if self.use_buffer:
+            return super(Ldml, self).serialize_xml(write, base, indent, topns, namespaces)
         if self.useDrafts:
             n = base if base is not None else self.root
             draft = n.get('draft', '')
@@ -892,6 +1616,24 @@ class Ldml(ETWriter):
                 if hasattr(c, 'tempnode') and c.tempnode:
                     n.remove(c)
 
+    def _children(self, n):
+        ''' Returns the children of n to output, with any alternates following the
+            element they are alternates of, and tidies up n's draft attribute. '''
+        if not self.useDrafts:
+            return list(n)
+        draft = n.get('draft', '')
+        if draft and (len(n) or draft == self.default_draft) and n.tag != "{" + self.silns + "}identity":
+            del n.attrib['draft']
+        alt = n.get('alt', '')
+        res = []
+        for c in n:
+            res.append(c)
+            if not getattr(c, 'alternates', None): continue
+            for a in sorted(c.alternates.keys()):
+                c.alternates[a].set('alt', (alt+"-"+a if alt else a))
+                res.append(c.alternates[a])
+        return res
+
     def get_draft(self, e, default=None):
         """ Return a draft numeric level for this node """
         ldraft = e.get('draft', None) if e is not None else None
@@ -0,0 +1,167 @@
+# -*- coding: utf-8
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+''' An index of the identity information, and fonts, of every file in an SLDR tree,
+kept on disk and brought up to date by looking only at the files that have changed,
+so that scripts can pick the locales they want without parsing them all. '''
+
+import os, pickle, hashlib
+from sldr.ldml import Ldml, filehash, savepickle, localns, localedir, iterate_files
+
+class IdentityIndex(object):
+    """ Maps each locale in dirs to a dict of:
+            path, mtime, size, hash     where the file is and what it was when read
+            language, script, territory, variant    identity/*/@type
+            silidentity                 whether there is an identity/special/sil:identity
+            silscript, defaultRegion, source, draft, uid, revid     its attributes
+            fonts                       a list of the attributes of each sil:font
+            blocks                      the top level elements
+            stub                        whether identity is the only top level element
+        Missing values are None. The index is kept in fname, by default in Ldml.cachedir.
+        With recursive, every file at any depth under dirs is indexed, keyed by its path
+        relative to its dir without the extension, rather than the first of each locale
+        found where the SLDR keeps them. """
+
+    _version = 2
+    _identityfields = ('language', 'script', 'territory', 'variant')
+    _silfields = (('silscript', 'script'), ('defaultRegion', 'defaultRegion'), ('source', 'source'),
+                  ('draft', 'draft'), ('uid', 'uid'), ('revid', 'revid'))
+
+    def __init__(self, dirs, fname=None, update=True, recursive=False):
+        self.dirs = [os.path.abspath(d) for d in dirs]
+        self.recursive = recursive
+        if fname is None and Ldml.cachedir:
+            key = hashlib.sha1("\n".join(self.dirs + [str(recursive)]).encode("utf-8")).hexdigest()[:16]
+            fname = os.path.join(Ldml.cachedir, 'identities', key + '.pickle')
+        self.fname = fname
+        self.entries = {}
+        if fname is not None:
+            try:
+                with open(fname, 'rb') as inf:
+                    (version, indexdirs, recursed, entries) = pickle.load(inf)
+                if version == self._version and indexdirs == self.dirs and recursed == recursive:
+                    self.entries = entries
+            except Exception:       # missing or unreadable, so rebuild it
+                pass
+        self.read = 0
+        if update:
+            self.update()
+
+    def _scan(self):
+        """ Returns a dict of locale to path, the first found for each, or of relative
+            name to path for every file if recursive """
+        res = {}
+        for d in self.dirs:
+            if self.recursive:
+                for path in iterate_files(d):
+                    res.setdefault(os.path.splitext(os.path.relpath(path, d))[0], path)
+                continue
+            for (lname, path) in localedir(d, rescan=True).items():
+                res.setdefault(lname, path)
+        return res
+
+    def _extract(self, path):
+        """ Reads the indexed fields from a file """
+        l = Ldml(path, blocks=('identity', 'special'))
+        res = {'path': path}
+        for k in self._identityfields:
+            e = l.find('identity/' + k)
+            res[k] = e.get('type', None) if e is not None else None
+        silid = l.find('identity/special/sil:identity')
+        res['silidentity'] = silid is not None
+        for k, a in self._silfields:
+            res[k] = silid.get(a, None) if silid is not None else None
+        res['fonts'] = [{localns(k): v for k, v in f.items()}
+                            for f in l.findall('special/sil:external-resources/sil:font')]
+        res['blocks'] = [localns(e.tag) for e in l.root]
+        res['stub'] = res['blocks'] == ['identity']
+        return res
+
+    def update(self, save=True):
+        """ Brings the index up to date with the files, reading only those whose size and
+            modification time, then contents, have changed. Returns the number of locales
+            added, changed or removed. """
+        files = self._scan()
+        changes = 0
+        for lname in [k for k in self.entries if k not in files]:
+            del self.entries[lname]
+            changes += 1
+        for lname, path in files.items():
+            s = os.stat(path)
+            old = self.entries.get(lname, None)
+            if old is not None and old['path'] == path and old['mtime'] == s.st_mtime_ns \
+                    and old['size'] == s.st_size:
+                continue
+            h = filehash(path)
+            if old is not None and old['path'] == path and old['hash'] == h:
+                old['mtime'] = s.st_mtime_ns
+                old['size'] = s.st_size
+                continue
+            try:
+                entry = self._extract(path)
+            except Exception:       # unparseable files are left out until they change
+                entry = {'path': path, 'error': True}
+            entry.update(mtime=s.st_mtime_ns, size=s.st_size, hash=h)
+            self.entries[lname] = entry
+            self.read += 1
+            changes += 1
+        if save and self.fname is not None:
+            try:
+                savepickle(self.fname, (self._version, self.dirs, self.recursive, self.entries))
+            except OSError:
+                pass
+        return changes
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, lname):
+        return lname in self.entries
+
+    def __iter__(self):
+        return iter(sorted(self.entries.keys()))
+
+    def get(self, lname, default=None):
+        return self.entries.get(lname, default)
+
+    def find(self, **filters):
+        """ Returns a sorted list of (locale, entry) for the entries matching all of the
+            filters. Each filter is a field name with a value to equal, or a function to
+            call on the field's value that returns True to match. Unreadable files never
+            match. """
+        res = []
+        for lname, e in self.entries.items():
+            if e.get('error', False):
+                continue
+            for k, v in filters.items():
+                if not (v(e.get(k, None)) if callable(v) else e.get(k, None) == v):
+                    break
+            else:
+                res.append((lname, e))
+        return sorted(res)
+
+    def paths(self, **filters):
+        """ Returns the sorted paths of the files matching the filters, as for find """
+        return sorted(e['path'] for lname, e in self.find(**filters))
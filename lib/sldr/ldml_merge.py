@@ -23,8 +23,9 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 
-from sldr.ldml import Ldml, _alldrafts
-import os
+from sldr.ldml import Ldml, _alldrafts, localedir
+from collections import OrderedDict
+import os, threading
 
 class _arrayDict(dict):
     def set(self, k, v):
@@ -45,9 +46,11 @@ class _arrayDict(dict):
 
 
 class LdmlMerge(Ldml):
+    use_hashindex = True        # align children through a dict of attrHash rather than a scan
+    _minindex = 16              # below this many children a scan is quicker
 
-    def __init__(self, fname, usedrafts=True, uparrows=False, winner=None):
-        super().__init__(fname, usedrafts=usedrafts, uparrows=uparrows)
+    def __init__(self, fname, usedrafts=True, uparrows=False, winner=None, cparser=None):
+        super().__init__(fname, usedrafts=usedrafts, uparrows=uparrows, cparser=cparser)
         self.winner = winner
 
     def difference(self, other, this=None):
@@ -57,46 +60,71 @@ class LdmlMerge(Ldml):
         # if empty elements, test .text and all the attributes
         if (not len(other) and not len(this)) or this.tag in self.blocks:
             return (other.contentHash == this.contentHash)
+        index = self._hashindex(this)
         for o in other:
-            for t in filter(lambda x: x.attrHash == o.attrHash, this):
-                if o.contentHash == t.contentHash or self.difference(o, this=t):
-                    if hasattr(t, 'alternates') and hasattr(o, 'alternates'):
-                        for (k, v) in o.alternates.items():
-                            if k in t.alternates and v.contentHash == t.alternates[k].contentHash:
-                                del t.alternates[k]
-                        if len(t.alternates) == 0:
-                            this.remove(t)
-                    else:
-                        this.remove(t)
-                break
+            t = self._firstmatch(o, this, index)
+            if t is not None and (o.contentHash == t.contentHash or self.difference(o, this=t)):
+                if hasattr(t, 'alternates') and hasattr(o, 'alternates'):
+                    for (k, v) in o.alternates.items():
+                        if k in t.alternates and v.contentHash == t.alternates[k].contentHash:
+                            del t.alternates[k]
+                    if len(t.alternates) == 0:
+                        self._removechild(t, this, index)
+                else:
+                    self._removechild(t, this, index)
         return not len(this) and (not this.text or this.text == other.text)
 
-    def overlay(self, other, usedrafts=False, this=None):
-        """Add missing information in self from other. Honours @draft attributes"""
+    def overlay(self, other, usedrafts=False, this=None, copy=False):
+        """Add missing information in self from other. Honours @draft attributes.
+           If copy is set, other is left untouched and copies of its elements are added."""
         if this == None: this = self.root
         other = getattr(other, 'root', other)
+        index = self._hashindex(this)
         for o in other:
             # simple if for now, if more use a dict
             if o.tag in self.blocks:
                 continue
             if o.tag == '{'+self.silns+'}external-resources':
-                self._overlay_external_resources(o, this, usedrafts)
+                self._overlay_external_resources(o, this, usedrafts, copy=copy)
             else:
-                self._overlay_child(o, this, usedrafts)
+                self._overlay_child(o, this, usedrafts, copy=copy, index=index)
 
-    def _overlay_child(self, o, this, usedrafts):
-        addme = True
-        for t in filter(lambda x: x.attrHash == o.attrHash, this):
-            addme = False
+    def _overlay_child(self, o, this, usedrafts, copy=False, index=None):
+        t = self._firstmatch(o, this, index)       # only do one alignment
+        if t is not None:
             if o.contentHash != t.contentHash:
-                self.overlay(o, usedrafts=usedrafts, this=t)
+                self.overlay(o, usedrafts=usedrafts, this=t, copy=copy)
                 if t.text == "↑↑↑" and o.text != "":
                     t.text = o.text
-            break  # only do one alignment
-        if addme and (o.tag != "alias" or not len(this)):  # alias in effect turns it into blocking
-            this.append(o)
+        elif o.tag != "alias" or not len(this):  # alias in effect turns it into blocking
+            n = self._copysubtree(o, this) if copy else o
+            this.append(n)
+            if index is not None:
+                index.set(n.attrHash, n)
+
+    def _hashindex(self, this):
+        """ Returns an _arrayDict of attrHash to the children of this, in document order,
+            or None if use_hashindex is off or this has too few children to be worth it """
+        if not self.use_hashindex or len(this) < self._minindex:
+            return None
+        res = _arrayDict()
+        for x in this:
+            res.set(x.attrHash, x)
+        return res
+
+    def _firstmatch(self, o, this, index=None):
+        """ Returns the first child of this with the same attrHash as o, or None """
+        if index is None:
+            return next((x for x in this if x.attrHash == o.attrHash), None)
+        res = index.get(o.attrHash, None)
+        return res[0] if res else None
+
+    def _removechild(self, t, this, index=None):
+        this.remove(t)
+        if index is not None:
+            index.remove(t.attrHash, t)
 
-    def _overlay_external_resources(self, other, this, usedrafts):
+    def _overlay_external_resources(self, other, this, usedrafts, copy=False):
         """Handle sil:font fallback mechanism"""
         silfonttag = '{'+self.silns+'}font'
         fonts = []
@@ -105,6 +133,7 @@ class LdmlMerge(Ldml):
             if t.tag == silfonttag:
                 fonts.append(t)
                 this.remove(t)
+        index = self._hashindex(this)
         for o in other:
             if o.tag == silfonttag:
                 types = o.get('types', '').split(' ')
@@ -120,9 +149,9 @@ class LdmlMerge(Ldml):
                             if t in tt:
                                 f.set('types', " ".join(x for x in tt if x != t))
                         fonts = [x for x in fonts if x.get('types', '') != '']
-                this.append(o)
+                this.append(self._copysubtree(o, this) if copy else o)
             else:
-                self._overlay_child(o, this, usedrafts)
+                self._overlay_child(o, this, usedrafts, copy=copy, index=index)
         for f in fonts:
             this.append(f)
 
@@ -373,30 +402,147 @@ class LdmlMerge(Ldml):
         return tval        # not sure what to do here. 'We' win!
 
 
-def getldml(lname, dirs, **kw):
+class FlattenContext(object):
+    """ Keeps the fallback locales that flattenlocale reads, so that flattening many
+        locales in one process parses root, en, etc. once rather than once per locale.
+        The cached files are never changed: overlays copy what they take from them.
+        Files are evicted, least recently used first, once the total size of their
+        source XML goes over maxsize bytes. maxsize counts the bytes of the files, not
+        the memory their parsed trees take, which is several times more. It can be
+        shared between threads. """
+
+    def __init__(self, dirs, maxsize=32<<20):
+        self.dirs = dirs
+        self.maxsize = maxsize
+        self.size = 0
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.used = set()
+        self.lock = threading.Lock()
+
+    def getldml(self, lname):
+        """ Returns the LdmlMerge for lname, or None if there isn't one. Adds lname to
+            used, which a caller can clear to find which locales a flatten looked at. """
+        self.used.add(lname)
+        with self.lock:
+            if lname in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(lname)
+                return self.cache[lname][0]
+            self.misses += 1
+        l = getldml(lname, self.dirs)       # parse without holding the lock
+        size = os.path.getsize(l.fname) if l is not None else 0
+        with self.lock:
+            if lname in self.cache:         # another thread read it meanwhile
+                return self.cache[lname][0]
+            self.cache[lname] = (l, size)
+            self.size += size
+            while self.size > self.maxsize and len(self.cache) > 1:
+                (k, (v, vsize)) = self.cache.popitem(last=False)
+                self.size -= vsize
+                self.evictions += 1
+        return l
+
+    def invalidate(self, lnames):
+        """ Forgets the given locales, e.g. because their files have changed """
+        with self.lock:
+            for l in lnames:
+                if l in self.cache:
+                    self.size -= self.cache.pop(l)[1]
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return "{} hits, {} misses ({:.1f}% hit rate), {} evicted; {} files of {:.1f}MB of XML, of {:.1f}MB".format(
+                    self.hits, self.misses, 100. * self.hits / lookups if lookups else 0., self.evictions,
+                    len(self.cache), self.size / 1048576., self.maxsize / 1048576.)
+
+
+def findldml(lname, dirs):
+    """ Returns the path of the LDML file for lname in dirs, or None """
+    for d in dirs:
+        f = localedir(d).find(lname)
+        if f is not None:
+            return f
+    return None
+
+def findldmlfile(fname, dirs):
+    """ Returns the path of fname in dirs, or None. A bare locale file name, such as
+        en_GB.xml, is found through the shared locale directory index. Any other name is
+        looked for in each directory, then in its first letter subdirectory. """
+    (name, ext) = os.path.splitext(fname)
     for d in dirs:
-        f = os.path.join(d, lname + '.xml')
+        if ext == '.xml' and os.path.dirname(fname) == '':
+            f = localedir(d).find(name)
+            if f is not None:
+                return f
+            continue
+        f = os.path.join(d, fname)
         if os.path.exists(f):
-            return LdmlMerge(f, **kw)
-        f = os.path.join(d, lname[0].lower(), lname + '.xml')
+            return f
+        f = os.path.join(d, fname[0].lower(), fname)
         if os.path.exists(f):
-            return LdmlMerge(f, **kw)
+            return f
+    return None
+
+def getldml(lname, dirs, **kw):
+    f = findldml(lname, dirs)
+    if f is not None:
+        return LdmlMerge(f, **kw)
     return None
 
+def trimtag(s):
+    """ Returns a locale name without its last subtag, or '' if there is only one """
+    r = s.rfind('_')
+    if r < 0:
+        return ''
+    else:
+        return s[:r]
+
+def fallbackchain(lname, parentLocales={}):
+    """ Returns the locales, nearest first, that flattenlocale falls back through for
+        lname, not including root """
+    res = []
+    f = parentLocales.get(lname, [trimtag(lname)])[0]
+    while len(f) and f != 'root' and f not in res:
+        res.append(f)
+        f = trimtag(f)
+    return res
+
+def localefamilies(locales, parentLocales={}, maxsize=None):
+    """ Groups locales into lists that share the same fallbacks (below root), in the order
+        they are given, so that each list can be flattened through one FlattenContext and
+        a family's parents are only parsed once. Each locale is still flattened against
+        its whole fallback chain: only the parsing is shared. Lists longer than maxsize are
+        split. Largest lists come first. """
+    families = {}
+    for l in locales:
+        chain = fallbackchain(l, parentLocales)
+        families.setdefault(chain[-1] if len(chain) else l, []).append(l)
+    res = []
+    for v in families.values():
+        size = maxsize or len(v)
+        res.extend(v[i:i+size] for i in range(0, len(v), size))
+    return sorted(res, key=lambda x:(-len(x), x[0]))
+
 def flattenlocale(lname, dirs=[], rev='f', changed=set(),
-                  skipstubs=False, fname=None, flattencollation=False, resolveAlias=False):
+                  skipstubs=False, fname=None, flattencollation=False, resolveAlias=False,
+                  context=None, used=None):
     """ Flattens an ldml file by filling in missing details from the fallback chain.
         If rev true, then do the opposite and unflatten a flat LDML file by removing
         everything that is the same in the fallback chain.
         changed contains an optional set of locales that if present says that the operation
         is only applied if one or more of the fallback locales are in the changed set.
+        context is an optional FlattenContext to read the fallback locales through.
+        used is an optional set that each fallback locale looked for is added to.
         Values for rev: f - flatten, r - unflatten, c - copy"""
-    def trimtag(s):
-        r = s.rfind('_')
-        if r < 0:
-            return ''
-        else:
-            return s[:r]
+    def getparent(f):
+        if used is not None:
+            used.add(f)
+        if context is not None:
+            return context.getldml(f)
+        return getldml(f, dirs)
 
     def getscript(l):
         ls = None
@@ -436,7 +582,7 @@ def flattenlocale(lname, dirs=[], rev='f', changed=set(),
         dome = True
         for f in fallbacks:    # apply each fallback
             while len(f):
-                o = getldml(f, dirs)
+                o = getparent(f)
                 if o is not None:
                     os = getscript(o)
                     if os is None or os == ls:
@@ -447,7 +593,7 @@ def flattenlocale(lname, dirs=[], rev='f', changed=set(),
                         else:
                             if f == 'root':
                                 l.flag_nonroots()
-                            l.overlay(o)
+                            l.overlay(o, copy=(context is not None))
                 f = trimtag(f)
             if not dome: break
     if resolveAlias:
@@ -460,7 +606,7 @@ def flattenlocale(lname, dirs=[], rev='f', changed=set(),
                 if l.fname.endswith(lang+'.xml'):
                     c = l
                 else:
-                    c = getldml(('root' if lang == 'und' else lang), dirs)
+                    c = getparent('root' if lang == 'und' else lang)
                 col = c.root.find('collations/collation[@type="{}"]/cr'.format(collmap.get(coll, coll)))
                 return col.text
             except:
@@ -0,0 +1,236 @@
+# -*- coding: utf-8
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+''' Serves flat, unflat and copied LDML, and the values in it, from a source tree
+kept in memory, so that a long running process need not regenerate or reread
+static files. '''
+
+import os, io, json, threading, time
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from sldr.ldml import Ldml, LocaleDir, localns, setlocaledir
+from sldr.ldml_merge import FlattenContext, flattenlocale
+
+class LdmlStore(object):
+    """ Flattens, unflattens or copies locales on demand, keeping the parent locales
+        in a FlattenContext and the last maxresults answers in an LRU. Each answer
+        remembers which locales it was made from, so that when files change only
+        the answers that depend on them are dropped. The lock only guards the LRU and
+        the list of files: answers are made outside it, so requests run in parallel. """
+
+    revs = {'flat': 'f', 'unflat': 'r', 'copy': 'c'}
+
+    def __init__(self, dirs, maxresults=256, maxsize=256<<20, flattencollation=False,
+                 resolveAlias=False, skipstubs=False, topns=False):
+        self.dirs = dirs
+        self.maxresults = maxresults
+        self.options = dict(flattencollation=flattencollation, resolveAlias=resolveAlias,
+                            skipstubs=skipstubs)
+        self.topns = topns
+        self.context = FlattenContext(dirs, maxsize=maxsize)
+        self.results = OrderedDict()
+        self.lock = threading.RLock()
+        self.generation = 0         # bumped by each invalidation
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        (self.files, ldirs) = self.scan()
+        for ldir in ldirs:
+            setlocaledir(ldir)
+
+    def scan(self):
+        """ Returns a dict of locale to (path, mtime, size) for every file in dirs, and
+            a fresh LocaleDir of each of dirs, for flattening to find its files through
+            once they are swapped in """
+        res = {}
+        ldirs = [LocaleDir(d) for d in self.dirs]
+        for ldir in ldirs:
+            for (lname, path) in ldir.items():
+                if lname not in res:
+                    try:
+                        s = os.stat(path)
+                    except OSError:
+                        continue
+                    res[lname] = (path, s.st_mtime_ns, s.st_size)
+        return (res, ldirs)
+
+    def locales(self):
+        return sorted(self.files.keys())
+
+    def _get(self, lname, rev):
+        """ Returns the (Ldml or None, xml text or None) for a locale, from the LRU or
+            by flattening it """
+        key = (lname, rev)
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return self.results[key][:2]
+            self.misses += 1
+            generation = self.generation
+            known = lname in self.files
+        used = set([lname])
+        l = None
+        if known:
+            l = flattenlocale(lname, dirs=self.dirs, rev=rev, context=self.context, used=used, **self.options)
+        text = None
+        if l is not None:
+            l.normalise()
+            out = io.StringIO()
+            l.serialize_xml(out.write, topns=self.topns, namespaces={})
+            text = out.getvalue()
+        with self.lock:
+            if generation == self.generation:   # else files changed while it was made
+                self.results[key] = (l, text, used)
+                while len(self.results) > self.maxresults:
+                    self.results.popitem(last=False)
+        return (l, text)
+
+    def get(self, lname, rev='f'):
+        """ Returns the serialised LDML for lname, flat (f), unflat (r) or copied (c),
+            or None if there is no such locale """
+        return self._get(lname, rev)[1]
+
+    def values(self, lname, path=None, rev='f'):
+        """ Returns a list of (xpath, text, {attribute: value}) for each leaf element
+            under path in lname, or for the whole file. Returns None if there is no
+            such locale. """
+        l = self._get(lname, rev)[0]
+        if l is None:
+            return None
+        res = []
+        def addvalues(e, xpath):
+            distkeys = l._distattributes(e.tag, False)
+            attrs = [(k, e.get(k)) for k in l._sortedattrs(e)]
+            keys = [(localns(k), v) for k, v in attrs if k in distkeys]
+            if xpath is None:
+                xpath = l.as_xpath(e)
+            else:
+                xpath += ("/" if xpath else "") + localns(e.tag) + "".join('[@{}="{}"]'.format(*x) for x in keys)
+            children = [c for c in e if isinstance(c.tag, str)]
+            if len(children):
+                for c in children:
+                    addvalues(c, xpath)
+            else:
+                res.append((xpath, e.text or "", {localns(k): v for k, v in attrs if k not in distkeys}))
+        if path:
+            for e in l.findall(path):
+                addvalues(e, None)
+        else:
+            for e in l.root:
+                if isinstance(e.tag, str):
+                    addvalues(e, "")
+        return res
+
+    def invalidate(self, lnames):
+        """ Drops the given locales and every answer made from them """
+        lnames = set(lnames)
+        with self.lock:
+            self.generation += 1
+            self.context.invalidate(lnames)
+            for k in [k for k, v in self.results.items() if not lnames.isdisjoint(v[2])]:
+                del self.results[k]
+                self.invalidations += 1
+
+    def refresh(self):
+        """ Looks for added, removed and changed files and invalidates what they affect.
+            Returns the locales that changed. """
+        (files, ldirs) = self.scan()       # outside the lock, into new LocaleDirs
+        with self.lock:
+            for ldir in ldirs:
+                setlocaledir(ldir)
+            changed = set(k for k in set(files) | set(self.files) if files.get(k) != self.files.get(k))
+            self.files = files
+            if len(changed):
+                self.invalidate(changed)
+        return changed
+
+    def watch(self, interval=2.):
+        """ Starts a daemon thread that refreshes every interval seconds """
+        def watcher():
+            while True:
+                time.sleep(interval)
+                self.refresh()
+        t = threading.Thread(target=watcher, daemon=True)
+        t.start()
+        return t
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return {'locales': len(self.files), 'results': len(self.results), 'hits': self.hits,
+                'misses': self.misses, 'hitrate': 100. * self.hits / lookups if lookups else 0.,
+                'invalidations': self.invalidations, 'parents': self.context.report()}
+
+
+class LdmlRequestHandler(BaseHTTPRequestHandler):
+    """ Answers GET /flat/<locale>, /unflat/<locale> and /copy/<locale> with LDML,
+        /values/<locale>?path=...&rev=flat with JSON [[xpath, text, {attributes}]],
+        /locales with a JSON list, and /stats with a JSON report. """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(x) for x in url.path.split('/') if x]
+        query = parse_qs(url.query)
+        store = self.server.store
+        if len(parts) == 1 and parts[0] == 'locales':
+            return self.reply(200, json.dumps(store.locales()), 'application/json')
+        elif len(parts) == 1 and parts[0] == 'stats':
+            return self.reply(200, json.dumps(store.report()), 'application/json')
+        elif len(parts) == 2 and parts[0] in store.revs:
+            res = store.get(parts[1], rev=store.revs[parts[0]])
+            if res is not None:
+                return self.reply(200, res, 'application/xml')
+        elif len(parts) == 2 and parts[0] == 'values':
+            rev = store.revs.get(query.get('rev', ['flat'])[0], None)
+            if rev is None:
+                return self.reply(400, "Unknown rev\n", 'text/plain')
+            res = store.values(parts[1], path=query.get('path', [None])[0], rev=rev)
+            if res is not None:
+                return self.reply(200, json.dumps(res, ensure_ascii=False), 'application/json')
+        else:
+            return self.reply(400, "Unknown request\n", 'text/plain')
+        return self.reply(404, "No such locale\n", 'text/plain')
+
+    def reply(self, code, text, mimetype):
+        data = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', mimetype + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def makeserver(store, host='127.0.0.1', port=8000, verbose=False):
+    """ Returns an HTTP server answering from store. Call serve_forever() on it. """
+    Ldml.LoadMetadata()
+    server = ThreadingHTTPServer((host, port), LdmlRequestHandler)
+    server.store = store
+    server.verbose = verbose
+    return server
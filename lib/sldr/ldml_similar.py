@@ -0,0 +1,195 @@
+# -*- coding: utf-8
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the University nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE REGENTS OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+''' Similarity between LDML files. Each file, or each of its top level blocks, is
+reduced to a MinHash signature of its leaf elements, and a locality sensitive
+hashing index over the signatures finds near duplicates without comparing every
+pair of files. '''
+
+from sldr.ldml import Ldml, stablehash
+
+def features(ldml, base=None, skip=('identity',)):
+    """ Returns the set of stable hashes of the leaf elements in base, or in the top
+        level blocks of the file that are not in skip. Each is hashed as its path and
+        its value. """
+    res = set()
+    def addfeatures(e, path):
+        distkeys = ldml._distattributes(e.tag, True)
+        attrs = sorted(e.items())
+        path += "/" + e.tag + "".join('[@{}="{}"]'.format(k, v) for k, v in attrs if k in distkeys)
+        if len(e):
+            for c in e:
+                if isinstance(c.tag, str):
+                    addfeatures(c, path)
+        else:
+            value = "".join('[@{}="{}"]'.format(k, v) for k, v in attrs if k not in distkeys)
+            res.add(stablehash(path + "=" + value + (e.text or "").strip()))
+    if base is not None:
+        addfeatures(base, "")
+    else:
+        for b in ldml.root:
+            if isinstance(b.tag, str) and b.tag not in skip:
+                addfeatures(b, "")
+    return res
+
+def blockfeatures(ldml, skip=('identity',)):
+    """ Returns a dict of top level block tag to its features """
+    res = {}
+    for b in ldml.root:
+        if isinstance(b.tag, str) and b.tag not in skip:
+            res.setdefault(b.tag, set()).update(features(ldml, base=b))
+    return res
+
+
+class MinHash(object):
+    """ A MinHash signature of a set of 64 bit hashes, made by one permutation hashing:
+        the hashes are split across numperm bins and the minimum of each bin kept. Empty
+        bins borrow from the next full bin, so signatures of small sets still compare. """
+
+    _empty = -1
+
+    def __init__(self, hashes=(), numperm=128):
+        self.numperm = numperm
+        self.size = len(hashes)
+        bins = [None] * numperm
+        for h in hashes:
+            i = h % numperm
+            v = h // numperm
+            if bins[i] is None or v < bins[i]:
+                bins[i] = v
+        if self.size:
+            # rotation densification: an empty bin takes the value of the next full bin,
+            # offset by the distance so that borrowed values differ from real ones
+            offset = (1 << 64) // numperm + 1
+            res = list(bins)
+            nextfull = None
+            for i in range(2 * numperm - 1, -1, -1):
+                if bins[i % numperm] is not None:
+                    nextfull = i
+                elif i < numperm:
+                    res[i] = bins[nextfull % numperm] + (nextfull - i) * offset
+            bins = res
+        else:
+            bins = [self._empty] * numperm
+        self.sig = tuple(bins)
+
+    def __repr__(self):
+        return "<{} size={}>".format(type(self).__name__, self.size)
+
+    def __len__(self):
+        return self.size
+
+    def jaccard(self, other):
+        """ Estimates the Jaccard similarity of the two underlying sets """
+        if not self.size or not other.size:
+            return 1. if self.size == other.size else 0.
+        return sum(1 for a, b in zip(self.sig, other.sig) if a == b) / self.numperm
+
+
+class LshIndex(object):
+    """ Locality sensitive hashing over MinHash signatures. Each signature is cut into
+        bands of rows values and files that share any band are candidates, which are then
+        checked against their signatures. Pairs with a similarity of about
+        (1 / bands) ** (1 / rows) or more are likely to be found. """
+
+    def __init__(self, bands=16, rows=8):
+        self.bands = bands
+        self.rows = rows
+        self.buckets = {}
+        self.sigs = {}
+
+    def __len__(self):
+        return len(self.sigs)
+
+    def __contains__(self, key):
+        return key in self.sigs
+
+    def _bandkeys(self, minhash):
+        if len(minhash.sig) < self.bands * self.rows:
+            raise ValueError("Signature of {} values is too short for {} bands of {} rows".format(
+                len(minhash.sig), self.bands, self.rows))
+        for i in range(self.bands):
+            yield (i, minhash.sig[i * self.rows:(i + 1) * self.rows])
+
+    def add(self, key, minhash):
+        """ Adds a signature under the given key. Empty signatures are kept but never match """
+        if key in self.sigs:
+            self.remove(key)
+        self.sigs[key] = minhash
+        if len(minhash):
+            for b in self._bandkeys(minhash):
+                self.buckets.setdefault(b, []).append(key)
+
+    def remove(self, key):
+        minhash = self.sigs.pop(key, None)
+        if minhash is None or not len(minhash):
+            return
+        for b in self._bandkeys(minhash):
+            keys = self.buckets[b]
+            keys.remove(key)
+            if not len(keys):
+                del self.buckets[b]
+
+    def candidates(self, minhash):
+        """ Returns the keys sharing at least one band with minhash """
+        res = set()
+        if len(minhash):
+            for b in self._bandkeys(minhash):
+                res.update(self.buckets.get(b, ()))
+        return res
+
+    def query(self, minhash, threshold=0.8):
+        """ Returns [(similarity, key)] for the indexed signatures whose similarity to
+            minhash is at least threshold, most similar first """
+        res = []
+        for k in self.candidates(minhash):
+            j = minhash.jaccard(self.sigs[k])
+            if j >= threshold:
+                res.append((j, k))
+        return sorted(res, key=lambda x: (-x[0], x[1]))
+
+    def similar(self, key, threshold=0.8):
+        """ Returns [(similarity, key)] of the near duplicates of an indexed key """
+        return [x for x in self.query(self.sigs[key], threshold) if x[1] != key]
+
+    def clusters(self, threshold=0.8):
+        """ Groups the keys into clusters linked by similarities of at least threshold.
+            Returns a list of sorted lists of keys, largest first, without singletons. """
+        parents = {}
+        def find(k):
+            while parents.get(k, k) != k:
+                parents[k] = parents.get(parents[k], parents[k])
+                k = parents[k]
+            return k
+        for keys in self.buckets.values():
+            for i, a in enumerate(keys):
+                for b in keys[i+1:]:
+                    ra, rb = find(a), find(b)
+                    if ra != rb and self.sigs[a].jaccard(self.sigs[b]) >= threshold:
+                        parents[max(ra, rb)] = min(ra, rb)
+        groups = {}
+        for k in parents:
+            groups.setdefault(find(k), []).append(k)
+        return sorted((sorted(v + [r]) for r, v in groups.items()), key=lambda x: (-len(x), x[0]))
@@ -2,7 +2,7 @@
 
 help () {
 cat << EOT
-$(basename $0) [-h | [-d] [-p] [-s] -S] TARGET
+$(basename $0) [-h | [-d] [-p] [-s] [-f] -S] TARGET
 	TARGET may be of the form:
 	  user@host -- for default document root based on hostname
 	  user@host:docroot -- for a custom docroot
@@ -11,6 +11,8 @@ $(basename $0) [-h | [-d] [-p] [-s] -S] TARGET
 	-d Dry-run print the commands executed and what this would change on
 	   the server.
 	-s Skip flattening phase.
+	-f Rebuild all of flat and unflat, rather than only what has changed
+	   since the last run.
 	-p Disable default sysops prefix to hostname.
 	-t Time the flatten and unflatten commands
 	-S Upload to staging area.
@@ -24,10 +26,11 @@ PREFIX=sysops.
 RSYNC_OPTS="-aP --no-p --no-g --no-t --compress --del"
 TARGET_SLDR="sldr"
 
-while getopts "dhpstSI:L:" f
+while getopts "dfhpstSI:L:" f
 do
   case $f in
     s)		SKIPFLAT=1;;
+    f)		FULLFLAT=1;;
     d)		DRYRUN="--dry-run -i";;
     p)		PREFIX=;;
     t)    TIMECMD="/usr/bin/time -v";;
@@ -64,14 +67,17 @@ shift 1
 
 if [ -z "$SKIPFLAT" ]
 then
+  if [ -n "$FULLFLAT" ]
+  then
+    rm -fr flat unflat flat.manifest unflat.manifest
+  fi
+
   echo "Make flattened sldr"
-  rm -fr flat
-  ${TIMECMD} python3 bin/ldmlflatten -o flat -i sldr -a -A -g
+  ${TIMECMD} python3 bin/ldmlflatten -o flat -i sldr -a -A -g -M flat.manifest
   echo "Completed flattened sldr"
 
   echo "Make unflattened sldr"
-  rm -fr unflat
-  ${TIMECMD} python3 bin/ldmlflatten -o unflat -i sldr -a -c -g
+  ${TIMECMD} python3 bin/ldmlflatten -o unflat -i sldr -a -c -g -M unflat.manifest
   echo "Completed unflatened sldr"
 fi
 
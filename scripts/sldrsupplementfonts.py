@@ -93,7 +93,7 @@ def processOneFile(fname, sldrPath):
     fonts = None
 
     fpath = os.path.join(sldrPath, fname[0], fname)
-    ldml = Ldml(fpath)
+    ldml = Ldml(fpath, blocks=("identity", "special"))
     # we have ldml file
 
     s = ldml.find('identity/script')
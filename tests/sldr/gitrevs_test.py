@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import unittest, sys, os, subprocess, tempfile
+
+try:
+    from sldr.gitrevs import GitRevisions, GitObjects
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from sldr.gitrevs import GitRevisions, GitObjects
+
+
+class GitRevisionsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.git("init", "-q")
+        for f in ("a.xml", "b.xml"):
+            self.write(f)
+        self.commit("one")
+        self.write("b.xml")
+        self.commit("two")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def git(self, *args):
+        return subprocess.check_output(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+                                       + list(args), cwd=self.tempdir.name).decode("utf-8")
+
+    def write(self, fname):
+        with open(os.path.join(self.tempdir.name, fname), "a") as outf:
+            outf.write("<ldml/>\n")
+
+    def commit(self, msg):
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", msg)
+
+    def test_revids(self):
+        """ Each file maps to the same commit a git log of just that file gives """
+        revs = GitRevisions(cwd=self.tempdir.name)
+        self.assertEqual(len(revs), 2)
+        for f in ("a.xml", "b.xml"):
+            fname = os.path.join(self.tempdir.name, f)
+            self.assertEqual(revs.revid(fname), self.git("log", "-n", "1", "--pretty=format:%H", f))
+        self.assertIsNone(revs.revid(os.path.join(self.tempdir.name, "c.xml")))
+
+    def test_revrange(self):
+        """ Only commits in the range are seen """
+        first = self.git("rev-list", "--max-parents=0", "HEAD").strip()
+        revs = GitRevisions(revrange=first+"..", cwd=self.tempdir.name)
+        self.assertIsNone(revs.revid(os.path.join(self.tempdir.name, "a.xml")))
+        self.assertEqual(revs.get(os.path.join(self.tempdir.name, "b.xml"))[0], self.git("rev-parse", "HEAD").strip())
+
+    def test_objects(self):
+        """ Files are read as they were at each revision """
+        objs = GitObjects(cwd=self.tempdir.name)
+        fname = os.path.join(self.tempdir.name, "b.xml")
+        self.assertEqual(objs.show("HEAD", fname), "<ldml/>\n" * 2)
+        self.assertEqual(objs.show("HEAD~1", fname), "<ldml/>\n")
+        self.assertIsNone(objs.show("HEAD", os.path.join(self.tempdir.name, "c.xml")))
+        self.assertEqual(objs.show("HEAD", os.path.join(self.tempdir.name, "a.xml")), "<ldml/>\n")
+        objs.close()
+
+if __name__ == '__main__':
+    unittest.main()
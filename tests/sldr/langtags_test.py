@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import unittest, sys, os, tempfile
+
+try:
+    from sldr.langtags_full import LangTag, LangTags, LangTagsIndex, Singleton, makealltags
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from sldr.langtags_full import LangTag, LangTags, LangTagsIndex, Singleton, makealltags
+
+
+alltags = """*aa = *aa-ET = aa-Latn = aa-Latn-ET
+*aa-DJ = aa-Latn-DJ
+en = en-Latn = en-US = en-Latn-US
+en-GB = en-Latn-GB
+sr = sr-Cyrl = sr-RS = sr-Cyrl-RS
+sr-Latn = sr-Latn-RS
+en-GB = en-Latn-GB-oxendict
+"""
+
+registry = """File-Date: 2024-01-01
+%%
+Type: language
+Subtag: aa
+Description: Afar
+%%
+Type: language
+Subtag: en
+Description: English
+Suppress-Script: Latn
+%%
+Type: language
+Subtag: sr
+Description: Serbian
+%%
+Type: language
+Subtag: zh
+Description: Chinese
+%%
+Type: extlang
+Subtag: yue
+Description: Yue Chinese
+Prefix: zh
+"""
+
+likely = """<supplementalData><likelySubtags>
+<likelySubtag from="aa" to="aa_Latn_ET"/>
+<likelySubtag from="en" to="en_Latn_US"/>
+<likelySubtag from="sr" to="{}"/>
+<likelySubtag from="zh" to="zh_Hans_CN"/>
+<likelySubtag from="und_Latn" to="en_Latn_US"/>
+</likelySubtags></supplementalData>
+"""
+
+supplemental = """<supplementalData><languageData>
+<language type="aa" scripts="Latn" territories="ET"/>
+<language type="sr" scripts="Cyrl Latn"/>
+</languageData><territoryInfo>
+<territory type="ET"><languagePopulation type="aa"/></territory>
+<territory type="DJ"><languagePopulation type="aa"/></territory>
+<territory type="US"><languagePopulation type="en"/></territory>
+</territoryInfo></supplementalData>
+"""
+
+def desc(t):
+    return (repr(t), str(t), t.hidescript, t.hideregion, t.hideboth)
+
+
+class LangTagsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tempdir.name, "langtags.txt")
+        with open(self.fname, "w") as outf:
+            outf.write(alltags)
+        self.cachedir = LangTags.cachedir
+        LangTags.cachedir = os.path.join(self.tempdir.name, "cache")
+
+    def tearDown(self):
+        LangTags.cachedir = self.cachedir
+        LangTags.use_index = True
+        Singleton._instances.pop(LangTags, None)
+        self.tempdir.cleanup()
+
+    def load(self, index):
+        Singleton._instances.pop(LangTags, None)
+        LangTags.use_index = index
+        return LangTags(alltags=self.fname)
+
+    def test_index(self):
+        """ Tags read lazily through the index are the same as those read at once """
+        full = self.load(False)
+        for i in range(2):
+            lazy = self.load(True)
+            self.assertIsNotNone(lazy.index)
+            self.assertIn("en-Latn-US", lazy)
+            self.assertNotIn("de", lazy)
+            self.assertEqual(desc(lazy["aa-ET"]), desc(full["aa-ET"]))
+            self.assertIs(lazy["aa-Latn"], lazy["aa"])
+            self.assertEqual(desc(lazy.get("en-GB")), desc(full["en-GB"]))
+            self.assertEqual(sorted(lazy.keys()), sorted(full.keys()))
+            self.assertEqual(lazy.generate_alltags(), full.generate_alltags())
+        self.assertEqual(len(os.listdir(os.path.join(LangTags.cachedir, "langtags"))), 1)
+
+    def test_build(self):
+        """ Each tag is found on the last line it is on """
+        fname = os.path.join(self.tempdir.name, "test.idx")
+        LangTagsIndex.build(fname, [["b", "a"], ["c"], ["a", "d"]], b"\0" * 32)
+        index = LangTagsIndex(fname)
+        self.assertEqual([index.find(t) for t in ("a", "b", "c", "d", "e", "")], [2, 0, 1, 2, -1, -1])
+        self.assertEqual(index.line(2), ["a", "d"])
+        self.assertEqual(list(index.tags()), [("a", 2), ("b", 0), ("c", 1), ("d", 2)])
+
+    def test_slots(self):
+        """ Subtags are shared between tags, and the public attributes still work """
+        a = LangTag("sr-Latn-RS-ekavsk-x-abc")
+        b = LangTag(lang="sr", script="Latn", variants=["ekavsk"], extensions={"x": ["abc"]})
+        self.assertIs(a.variants, b.variants)
+        self.assertEqual(a.variants, ("ekavsk",))
+        self.assertIs(a.extensions["x"], b.extensions["x"])
+        self.assertTrue(a.matches(LangTag("sr-Latn-RS-ekavsk-x-abc")))
+        self.assertEqual(repr(a), "sr-Latn-RS-ekavsk-x-abc")
+        self.assertEqual(a.base, [])
+        self.assertEqual(getattr(a, 'desc', []), [])
+        a.desc = ["Serbian"]
+        a.comment = "not a slot"
+        self.assertEqual((a.desc, a.comment), (["Serbian"], "not a slot"))
+        self.assertEqual(b.__dict__, {})
+
+    def test_analyse(self):
+        """ Analysing a tag again comes from the cache, until the tags change """
+        lts = self.load(True)
+        plain = dict((k, lts[k]) for k in lts.keys())
+        tags = ("en-Latn-ZZ", "aa-x-test", "sr-Latn-RS-ekavsk", "aa-Latn-ET-fonipa")
+        full = [desc(LangTag(t).analyse(plain)) for t in tags]
+        self.assertEqual([desc(LangTag(t).analyse(lts)) for t in tags], full)
+        misses = lts.cachestats()['analyse']['misses']
+        self.assertEqual([desc(LangTag(t).analyse(lts)) for t in tags], full)
+        stats = lts.cachestats()['analyse']
+        self.assertEqual((stats['hits'], stats['misses']), (len(tags), misses))
+        lts.add(LangTag("aa-x-test").analyse(lts))
+        self.assertEqual(lts.cachestats()['analyse']['size'], 0)
+        self.assertIs(LangTag("aa-x-test").analyse(lts), lts["aa-x-test"])
+
+    def test_lookup_many(self):
+        """ Tags are found as given, normalised or through fallbacks, once each """
+        lts = self.load(True)
+        found, misses = lts.lookup_many(["en-US", "aa_latn", "eng", "de_de", "zz", "en-US", "xyz"],
+                                        fallbacks=[{"eng": "en"}, lambda t: "sr" if t == "zz" else None])
+        self.assertEqual(list(found), ["en-US", "aa_latn", "eng", "zz"])
+        self.assertEqual(found["en-US"][:4], ("en-US", "en-US", "en-US", "en-Latn-US"))
+        self.assertIsNone(found["en-US"].fallback)
+        self.assertEqual(found["aa_latn"][1:3], ("aa-Latn", str(lts["aa"])))
+        self.assertIs(found["aa_latn"].langtag, lts["aa"])
+        self.assertEqual((found["eng"].found, found["eng"].fallback), ("en", 0))
+        self.assertEqual((found["zz"].found, found["zz"].fallback), ("sr", 1))
+        self.assertEqual(misses, [("de_de", ["de_de", "de-DE"]), ("xyz", ["xyz"])])
+
+    def test_update(self):
+        """ Remaking only the languages whose sources changed gives what remaking all does """
+        sources = {}
+        for k, v in (("iana", registry), ("likely", likely.format("sr_Cyrl_RS")),
+                     ("supplemental", supplemental)):
+            sources[k] = os.path.join(self.tempdir.name, k)
+            with open(sources[k], "w") as outf:
+                outf.write(v)
+        locales = ["aa_DJ", "en_GB", "sr_Latn", "yue"]
+        findfile = lambda x: x.replace("-", "_") in locales
+        (previous, count) = makealltags(locales, findfile, sources=sources)
+        self.assertEqual(count, 5)
+        self.assertIn("aa = aa-ET = aa-Latn = aa-Latn-ET", previous)
+        self.assertIn("*aa-DJ", previous)
+        self.assertEqual(makealltags(locales, findfile, previous=previous, sources=sources), (previous, 0))
+        with open(sources["likely"], "w") as outf:
+            outf.write(likely.format("sr_Latn_RS"))
+        locales.append("zh_TW")
+        (lines, count) = makealltags(locales, findfile, previous=previous, sources=sources)
+        self.assertEqual(count, 2)
+        self.assertNotEqual(lines, previous)
+        self.assertEqual([l for l in lines if not l.startswith(("sr", "*sr", "zh", "*zh"))],
+                         [l for l in previous if not l.startswith(("sr", "*sr", "zh", "*zh"))])
+        self.assertEqual(makealltags(locales, findfile, sources=sources), (lines, 5))
+        self.assertEqual(makealltags(locales, findfile, previous=previous + ["aa"], sources=sources),
+                         (lines, 5))      # no digests kept for that, so all are made
+        lts = LangTags.build(["sr"], **sources)
+        self.assertEqual(sorted(set(LangTag(k).lang for k in lts.keys())), ["sr"])
+        self.assertIsNot(lts, LangTags())
+
+if __name__ == '__main__':
+    unittest.main()
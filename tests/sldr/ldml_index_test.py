@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import unittest, sys, os, tempfile
+
+try:
+    from sldr.ldml_index import IdentityIndex
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from sldr.ldml_index import IdentityIndex
+
+
+template = """<?xml version="1.0" encoding="UTF-8"?>
+<ldml xmlns:sil="urn://www.sil.org/ldml/0.1">
+  <identity>
+    <version number="$Revision$"/>
+    <language type="{0}"/>
+    <special>
+      <sil:identity source="{1}" script="Latn" defaultRegion="FR"/>
+    </special>
+  </identity>
+  {2}
+</ldml>
+"""
+
+fonts = """<special>
+    <sil:external-resources>
+      <sil:font name="Charis SIL" types="default"/>
+    </sil:external-resources>
+  </special>"""
+
+
+class IndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dir = os.path.join(self.tempdir.name, "sldr")
+        os.makedirs(os.path.join(self.dir, "a"))
+        os.makedirs(os.path.join(self.dir, "b"))
+        self.fname = os.path.join(self.tempdir.name, "index.pickle")
+        self.write("aa", "a", "cldr", "")
+        self.write("ab", "a", "", fonts)
+        self.write("ba", "b", "", "<characters/>")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, lang, sub, source, rest):
+        path = os.path.join(self.dir, sub, lang + ".xml")
+        with open(path, "w") as outf:
+            outf.write(template.format(lang, source, rest))
+        return path
+
+    def test_extract(self):
+        """ The identity, sil:identity and fonts of each file are indexed """
+        index = IdentityIndex([self.dir], fname=self.fname)
+        self.assertEqual((len(index), index.read), (3, 3))
+        e = index.get("ab")
+        self.assertEqual((e['language'], e['script'], e['silscript'], e['defaultRegion'], e['source']),
+                         ("ab", None, "Latn", "FR", ""))
+        self.assertEqual(e['fonts'], [{'name': "Charis SIL", 'types': "default"}])
+        self.assertEqual(e['blocks'], ['identity', 'special'])
+        self.assertTrue(index.get("aa")['stub'])
+        self.assertEqual([l for l, e in index.find(stub=False)], ["ab", "ba"])
+        self.assertEqual(index.paths(source=lambda x: x != "cldr", stub=True), [])
+        self.assertEqual(index.paths(source="cldr"), [os.path.join(self.dir, "a", "aa.xml")])
+
+    def test_update(self):
+        """ A reloaded index only reads files that have changed """
+        IdentityIndex([self.dir], fname=self.fname)
+        index = IdentityIndex([self.dir], fname=self.fname)
+        self.assertEqual((len(index), index.read), (3, 0))
+        # same contents, newer time: hashed but not read
+        path = self.write("aa", "a", "cldr", "")
+        os.utime(path, ns=(1, 1))
+        self.assertEqual(index.update(), 0)
+        path = self.write("ba", "b", "", fonts)
+        os.utime(path, ns=(2, 2))
+        os.remove(os.path.join(self.dir, "a", "ab.xml"))
+        with open(os.path.join(self.dir, "b", "bad.xml"), "w") as outf:
+            outf.write("<ldml>")
+        index = IdentityIndex([self.dir], fname=self.fname)
+        self.assertEqual((len(index), index.read), (3, 2))
+        self.assertNotIn("ab", index)
+        self.assertEqual(index.get("ba")['fonts'][0]['name'], "Charis SIL")
+        self.assertEqual([l for l, e in index.find()], ["aa", "ba"])
+
+    def test_recursive(self):
+        """ A recursive index takes every file, however deep """
+        os.makedirs(os.path.join(self.dir, "a", "old"))
+        self.write("aa", os.path.join("a", "old"), "", fonts)
+        index = IdentityIndex([self.dir], fname=self.fname, recursive=True)
+        self.assertEqual(list(index), [os.path.join("a", "aa"), os.path.join("a", "ab"),
+                                       os.path.join("a", "old", "aa"), os.path.join("b", "ba")])
+        self.assertEqual(index.paths(source=""), [os.path.join(self.dir, "a", "ab.xml"),
+                    os.path.join(self.dir, "a", "old", "aa.xml"), os.path.join(self.dir, "b", "ba.xml")])
+        # a flat index does not take up the entries of a recursive one
+        self.assertEqual(len(IdentityIndex([self.dir], fname=self.fname)), 3)
+
+if __name__ == '__main__':
+    unittest.main()
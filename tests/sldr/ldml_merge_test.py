@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import unittest, sys, os, shutil, tempfile
+from io import StringIO
+
+try:
+    from sldr.ldml_merge import LdmlMerge, FlattenContext, flattenlocale, fallbackchain, localefamilies, findldmlfile
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from sldr.ldml_merge import LdmlMerge, FlattenContext, flattenlocale, fallbackchain, localefamilies, findldmlfile
+
+
+def xmlstr(l):
+    res = StringIO()
+    l.normalise()
+    l.serialize_xml(res.write, topns=False, namespaces={})
+    return res.getvalue()
+
+
+class FlattenTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirs = [self.tempdir.name]
+        testdir = os.path.dirname(__file__)
+        for f, t in (("test1b", "root"), ("test1o", "sg"), ("test1t", "sg_CF"), ("test1t", "sg_TD")):
+            shutil.copy(os.path.join(testdir, f + ".xml"), os.path.join(self.tempdir.name, t + ".xml"))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_context(self):
+        """ Flattening through a FlattenContext gives the same results, leaves the
+            cached parents alone and reads each parent once """
+        context = FlattenContext(self.dirs)
+        for rev in ('f', 'r'):
+            for l in ("sg_CF", "sg_TD"):
+                self.assertEqual(xmlstr(flattenlocale(l, dirs=self.dirs, rev=rev)),
+                                 xmlstr(flattenlocale(l, dirs=self.dirs, rev=rev, context=context)))
+        self.assertEqual((context.hits, context.misses), (4, 2))
+        self.assertEqual(xmlstr(context.getldml("sg")), xmlstr(flattenlocale("sg", dirs=self.dirs, rev='c')))
+        used = set()
+        flattenlocale("sg_CF", dirs=self.dirs, used=used)
+        self.assertEqual(used, {"sg", "root"})
+
+    def test_eviction(self):
+        """ The context keeps to its size limit """
+        context = FlattenContext(self.dirs, maxsize=1)
+        for l in ("root", "sg", "root"):
+            context.getldml(l)
+        self.assertEqual((context.hits, context.misses, context.evictions, len(context.cache)), (0, 3, 2, 1))
+
+    def test_families(self):
+        """ Locales are grouped by their fallbacks, in the order given """
+        parents = {'es_AR': ['es_419'], 'az_Cyrl': ['root']}
+        self.assertEqual(fallbackchain('sr_Latn_ME'), ['sr_Latn', 'sr'])
+        self.assertEqual(fallbackchain('es_AR', parents), ['es_419', 'es'])
+        self.assertEqual(fallbackchain('az_Cyrl', parents), [])
+        self.assertEqual(localefamilies(['es_AR', 'root', 'az_Cyrl', 'es', 'az', 'es_419'], parents),
+                         [['es_AR', 'es', 'es_419'], ['az'], ['az_Cyrl'], ['root']])
+        self.assertEqual(localefamilies(['es_AR', 'es', 'es_419'], parents, maxsize=2),
+                         [['es_AR', 'es'], ['es_419']])
+
+    def test_findfile(self):
+        """ Bare locale file names are found in the directories, and paths as given """
+        os.mkdir(os.path.join(self.tempdir.name, "s"))
+        shutil.move(os.path.join(self.tempdir.name, "sg_TD.xml"), os.path.join(self.tempdir.name, "s", "sg_TD.xml"))
+        d = self.tempdir.name
+        self.assertEqual(findldmlfile("sg_TD.xml", self.dirs), os.path.join(d, "s", "sg_TD.xml"))
+        self.assertEqual(findldmlfile("sg_CF.xml", self.dirs), os.path.join(d, "sg_CF.xml"))
+        self.assertEqual(findldmlfile(os.path.join("s", "sg_TD.xml"), self.dirs), os.path.join(d, "s", "sg_TD.xml"))
+        self.assertEqual(findldmlfile(os.path.join(d, "s", "sg_TD.xml"), ["."]), os.path.join(d, "s", "sg_TD.xml"))
+        self.assertIsNone(findldmlfile("xx.xml", self.dirs))
+
+    def test_alignment(self):
+        """ Aligning children through the attrHash index gives the same as scanning """
+        def langs(order, changed):
+            return StringIO("<ldml><localeDisplayNames><languages>" + "".join(
+                '<language type="l{0:02d}">Lang {0}{1}</language>'.format(i, "X" if i in changed else "")
+                    for i in order) + "</languages></localeDisplayNames></ldml>")
+        res = []
+        for index in (False, True):
+            LdmlMerge.use_hashindex = index
+            try:
+                parent = LdmlMerge(langs(range(40), ()))
+                child = LdmlMerge(langs(range(39, -1, -1), (3, 20)))
+                child.difference(parent)
+                other = LdmlMerge(langs(range(0, 60, 2), (4,)))
+                other.overlay(parent, copy=True)
+                res.append((xmlstr(child), xmlstr(other)))
+            finally:
+                LdmlMerge.use_hashindex = True
+        self.assertEqual(res[0], res[1])
+        self.assertEqual(res[1][0].count("<language "), 2)
+        self.assertEqual(res[1][1].count("<language "), 50)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import unittest, sys, os, shutil, tempfile, threading, json, time
+from io import StringIO
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+try:
+    from sldr.ldml_merge import flattenlocale
+    from sldr.ldml_server import LdmlStore, makeserver
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from sldr.ldml_merge import flattenlocale
+    from sldr.ldml_server import LdmlStore, makeserver
+
+
+def xmlstr(l):
+    res = StringIO()
+    l.normalise()
+    l.serialize_xml(res.write, topns=False, namespaces={})
+    return res.getvalue()
+
+
+class StoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dirs = [self.tempdir.name]
+        testdir = os.path.dirname(__file__)
+        for f, t in (("test1b", "root"), ("test1o", "sg"), ("test1t", "sg_CF"), ("test1t", "en")):
+            shutil.copy(os.path.join(testdir, f + ".xml"), os.path.join(self.tempdir.name, t + ".xml"))
+        self.store = LdmlStore(self.dirs)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_get(self):
+        """ Answers are the same as flattenlocale gives, and repeats come from the LRU """
+        for rev in ('f', 'r', 'c'):
+            self.assertEqual(self.store.get("sg_CF", rev=rev), xmlstr(flattenlocale("sg_CF", dirs=self.dirs, rev=rev)))
+        self.store.get("sg_CF")
+        self.assertEqual((self.store.hits, self.store.misses), (1, 3))
+        self.assertIsNone(self.store.get("xx"))
+        values = dict((x[0], x[1]) for x in self.store.values("sg_CF", "characters"))
+        self.assertIn('characters/exemplarCharacters[@type="auxiliary"]', values)
+
+    def test_invalidate(self):
+        """ Only answers made from changed files are dropped """
+        self.store.get("sg_CF")
+        self.store.get("en")
+        fname = os.path.join(self.tempdir.name, "sg.xml")
+        with open(fname, "a") as outf:
+            outf.write("\n")
+        os.utime(fname, ns=(time.time_ns() + 10**9, time.time_ns() + 10**9))
+        self.assertEqual(self.store.refresh(), set(["sg"]))
+        self.assertEqual(sorted(self.store.results.keys()), [("en", "f")])
+        self.assertIsNone(self.store.get("xx"))
+        shutil.copy(os.path.join(self.tempdir.name, "sg_CF.xml"), os.path.join(self.tempdir.name, "xx.xml"))
+        self.assertEqual(self.store.refresh(), set(["xx"]))
+        self.assertEqual(sorted(self.store.results.keys()), [("en", "f")])
+        self.assertIsNotNone(self.store.get("xx"))
+
+    def test_threads(self):
+        """ Answers made in parallel, while the files are refreshed, are the same """
+        expected = dict((l, xmlstr(flattenlocale(l, dirs=self.dirs))) for l in ("sg_CF", "en", "sg"))
+        res = []
+        def worker():
+            for i in range(2):
+                for l in expected:
+                    res.append(self.store.get(l) == expected[l])
+                self.store.invalidate(["root"])
+        threads = [threading.Thread(target=worker) for i in range(3)]
+        for t in threads:
+            t.start()
+        for i in range(3):
+            self.store.refresh()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(res), 18)
+        self.assertTrue(all(res))
+
+    def test_http(self):
+        """ The server answers over HTTP """
+        server = makeserver(self.store, port=0)
+        t = threading.Thread(target=server.serve_forever, daemon=True)
+        t.start()
+        try:
+            url = "http://{}:{}/".format(*server.server_address[:2])
+            self.assertEqual(urlopen(url + "flat/sg_CF").read().decode("utf-8"), self.store.get("sg_CF"))
+            self.assertEqual(json.loads(urlopen(url + "locales").read().decode("utf-8")), ["en", "root", "sg", "sg_CF"])
+            with self.assertRaises(HTTPError) as e:
+                urlopen(url + "unflat/xx")
+            self.assertEqual(e.exception.code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
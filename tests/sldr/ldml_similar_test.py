@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import unittest, sys, os, random
+
+try:
+    from sldr.ldml import Ldml
+    from sldr.ldml_similar import MinHash, LshIndex, features, blockfeatures
+except ImportError:
+    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
+    from sldr.ldml import Ldml
+    from sldr.ldml_similar import MinHash, LshIndex, features, blockfeatures
+
+
+class SimilarityTests(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.base = set(rand.getrandbits(64) for i in range(2000))
+        self.near = set(list(self.base)[:1900]) | set(rand.getrandbits(64) for i in range(100))
+        self.other = set(rand.getrandbits(64) for i in range(2000))
+
+    def test_jaccard(self):
+        """ Signatures estimate the similarity of their sets """
+        exact = len(self.base & self.near) / len(self.base | self.near)
+        self.assertAlmostEqual(MinHash(self.base).jaccard(MinHash(self.near)), exact, delta=0.1)
+        self.assertLess(MinHash(self.base).jaccard(MinHash(self.other)), 0.1)
+        self.assertEqual(MinHash(set(list(self.base)[:5])).jaccard(MinHash(set(list(self.base)[:5]))), 1.)
+        self.assertEqual(MinHash().jaccard(MinHash(self.base)), 0.)
+
+    def test_index(self):
+        """ The index finds near duplicates and clusters them """
+        index = LshIndex()
+        for k, v in (("a", self.base), ("b", self.near), ("c", self.other), ("d", set())):
+            index.add(k, MinHash(v))
+        self.assertEqual([k for j, k in index.similar("a")], ["b"])
+        self.assertEqual(index.similar("c"), [])
+        self.assertEqual(index.clusters(), [["a", "b"]])
+        index.remove("b")
+        self.assertEqual(index.clusters(), [])
+
+    def test_features(self):
+        """ Files with the same content have the same features, whatever their identity """
+        testdir = os.path.dirname(__file__)
+        l = Ldml(os.path.join(testdir, "test1t.xml"))
+        feats = features(l)
+        self.assertEqual(feats, features(Ldml(os.path.join(testdir, "test1t.xml"))))
+        self.assertEqual(feats, set().union(*blockfeatures(l).values()))
+        self.assertNotIn("identity", blockfeatures(l))
+        self.assertLess(MinHash(feats).jaccard(MinHash(features(Ldml(os.path.join(testdir, "sg.xml"))))), 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 
-import unittest, sys, os
+import unittest, sys, os, tempfile, subprocess
 from io import StringIO
+from xml.etree import ElementTree as et
 
 try:
-    from sldr.ldml import Ldml, draftratings
+    from sldr.ldml import Ldml, ETWriter, SnapshotCache, draftratings, LocaleDir, iterate_files, getldml
 except ImportError:
     sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib')))
-    from sldr.ldml import Ldml, draftratings, etwrite
+    from sldr.ldml import Ldml, ETWriter, SnapshotCache, draftratings, etwrite, LocaleDir, iterate_files, getldml
 
 
 class LDMLTests(unittest.TestCase):
@@ -118,5 +119,233 @@ class LDMLTests(unittest.TestCase):
         self.ldml.serialize_xml(res.write)
         self.assertEqual(res.getvalue().strip(), self.tf)
 
+    def test_cparser(self):
+        """ The C parser gives the same tree, which can still be added to """
+        l = Ldml(StringIO(self.tf), cparser=True)
+        res = StringIO()
+        l.serialize_xml(res.write)
+        self.assertEqual(res.getvalue().strip(), self.tf)
+        n = l.ensure_path("identity/special/fred", text="Hello World")[0]
+        self.assertTrue(n.parent.parent.parent is l.root and n.document is l)
+
+    def test_buffered(self):
+        """ The buffered writer gives the same output as the recursive one """
+        l = Ldml(os.path.join(os.path.dirname(__file__), "test1t.xml"))
+        self.ldml.ensure_path('characters/exemplarCharacters[@type="index"]', text="[a & b]", draft="unconfirmed")
+        res = {}
+        old = ETWriter.use_buffer
+        try:
+            for b in (False, True):
+                ETWriter.use_buffer = b
+                for topns in (False, True):
+                    for x in (l, self.ldml):
+                        out = StringIO()
+                        x.serialize_xml(out.write, topns=topns, namespaces={})
+                        res.setdefault(b, []).append(out.getvalue())
+        finally:
+            ETWriter.use_buffer = old
+        self.assertEqual(res[False], res[True])
+        self.assertIn('&amp;', res[True][1])
+
+    def test_childindex(self):
+        """ Path lookups through the child index follow changes to the tree """
+        Ldml.use_childindex = True
+        try:
+            l = Ldml(StringIO(self.tf))
+        finally:
+            Ldml.use_childindex = False
+        for t in ("fr", "de", "en"):
+            l.ensure_path('localeDisplayNames/languages/language[@type="{}"]'.format(t), text=t.upper())
+        self.assertEqual(l.find('localeDisplayNames/languages/language[@type="de"]').text, "DE")
+        n = l.find('localeDisplayNames/languages/language[@type="fr"]')
+        n.set('type', 'fr_CA')
+        self.assertIsNone(l.find('localeDisplayNames/languages/language[@type="fr"]'))
+        self.assertIs(l.find('localeDisplayNames/languages/language[@type="fr_CA"]'), n)
+        l.remove_path('localeDisplayNames/languages/language[@type="de"]')
+        self.assertIsNone(l.find('localeDisplayNames/languages/language[@type="de"]'))
+        self.assertEqual(len(l.findall('localeDisplayNames/languages/language')), 2)
+
+    def test_childindex_subelement(self):
+        """ The child index of C parser trees sees children added by et.SubElement """
+        for compact in (False, True):
+            Ldml.use_childindex = True
+            Ldml.use_compactnodes = compact
+            try:
+                l = Ldml(StringIO(self.tf), cparser=True)
+            finally:
+                Ldml.use_childindex = False
+                Ldml.use_compactnodes = False
+            l.ensure_path('localeDisplayNames/languages/language[@type="fr"]', text="FR")
+            langs = l.find('localeDisplayNames/languages')
+            self.assertEqual(len(langs.children_by_tag('language')), 1)
+            et.SubElement(langs, 'language', type='de')
+            self.assertEqual(l.find('localeDisplayNames/languages/language[@type="de"]').get('type'), 'de')
+            self.assertEqual(len(l.findall('localeDisplayNames/languages/language')), 2)
+            self.assertIs(type(ETWriter.addnode(l, langs, 'language', type='en')), type(langs))
+            self.assertIsNotNone(l.find('localeDisplayNames/languages/language[@type="en"]'))
+
+    def test_compactnodes(self):
+        """ CompactElement trees give the same output and keep no dict on their nodes """
+        fname = os.path.join(os.path.dirname(__file__), "test1t.xml")
+        res = []
+        for compact in (False, True):
+            Ldml.use_compactnodes = compact
+            Ldml.use_childindex = compact
+            try:
+                l = Ldml(fname, usedrafts=True)
+            finally:
+                Ldml.use_compactnodes = False
+                Ldml.use_childindex = False
+            l.ensure_path('characters/exemplarCharacters[@type="index"]', text="[a b]")
+            l.normalise(usedrafts=True)
+            out = StringIO()
+            l.serialize_xml(out.write, namespaces={})
+            res.append(out.getvalue())
+        self.assertEqual(res[0], res[1])
+        self.assertTrue(all(isinstance(e.contentHash, int) for e in l.root.iter()))
+        self.assertFalse(any(hasattr(e, '__dict__') and len(e.__dict__) for e in l.root.iter()))
+
+    def test_incremental_normalise(self):
+        """ Normalising only what has changed gives the same tree as a full normalise """
+        fname = os.path.join(os.path.dirname(__file__), "test1t.xml")
+        res = []
+        for full in (True, False):
+            l = Ldml(fname)
+            self.assertFalse(l.normalise(usedrafts=True, full=full))
+            l.ensure_path('localeDisplayNames/languages/language[@type="zz"]', text="Zz")
+            l.find('localeDisplayNames/measurementSystemNames/measurementSystemName[@type="UK"]').text = "GB"
+            l.normalise(full=full)
+            l.normalise(usedrafts=True, full=full)
+            out = StringIO()
+            l.serialize_xml(out.write, namespaces={})
+            res.append([out.getvalue()] + [(e.contentHash, e.attrHash) for e in l.root.iter()])
+        self.assertEqual(res[0], res[1])
+        self.assertTrue(l.normalise(usedrafts=True))
+        # only the latest setting's state is kept
+        self.assertFalse(l.normalise(usedrafts=False, addguids=False))
+        self.assertFalse(l.normalise(usedrafts=True))
+
+    def test_blocks(self):
+        """ Reading only some blocks writes the others back as they were """
+        fname = os.path.join(os.path.dirname(__file__), "sg.xml")
+        out = StringIO()
+        Ldml(fname).serialize_xml(out.write, topns=False, namespaces={})
+        res = []
+        for blocks in (None, ['identity', 'special'], ['characters']):
+            l = Ldml(StringIO(out.getvalue()), blocks=blocks)
+            o = StringIO()
+            l.serialize_xml(o.write, topns=False, namespaces={})
+            res.append(o.getvalue())
+        self.assertEqual(res[0], res[1])
+        self.assertEqual(res[0], res[2])
+        l = Ldml(StringIO(out.getvalue()), blocks=['characters'])
+        self.assertIn('identity', l.skipped)
+        self.assertIsNotNone(l.find('characters/exemplarCharacters[@type="auxiliary"]'))
+        self.assertIsNone(l.find('identity/language'))
+        l.ensure_path('dates/calendars/calendar[@type="gregorian"]')
+        with self.assertRaises(ValueError):
+            l.serialize_xml(StringIO().write, namespaces={})
+        data = '<ldml><identity><language type="sg"/></identity><layout /><characters/></ldml>'
+        l = Ldml(StringIO(data), blocks=['identity'])
+        self.assertEqual(l.skipped, ['layout', 'characters'])
+        self.assertEqual(l.find('identity/language').get('type'), 'sg')
+
+    def test_stablehash(self):
+        """ Stable hashes do not change with the process's hash seed """
+        libdir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+        prog = "import sys; from io import StringIO; from sldr.ldml import Ldml; Ldml.use_stablehash = True; " \
+               "l = Ldml(StringIO(sys.stdin.read())); print(l.root.contentHash, l.root.attrHash)"
+        res = set()
+        for seed in ('1', '2'):
+            env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=libdir)
+            res.add(subprocess.run([sys.executable, '-c', prog], input=self.tf, env=env,
+                                   capture_output=True, text=True, check=True).stdout)
+        self.assertEqual(len(res), 1)
+
+class MetadataTests(unittest.TestCase):
+
+    tf = '''<?xml version="1.0" encoding="utf-8"?>
+<ldml xmlns:sil="urn://www.sil.org/ldml/0.1">
+	<identity>
+		<language type="sg"/>
+		<special>
+			<sil:identity uid="test2"/>
+		</special>
+	</identity>
+	<characters>
+		<exemplarCharacters>[a b d e f g]</exemplarCharacters>
+	</characters>
+</ldml>'''
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.oldcache = Ldml.cachedir
+        Ldml.cachedir = self.tempdir.name
+
+    def tearDown(self):
+        Ldml.cachedir = self.oldcache
+        self.tempdir.cleanup()
+
+    def test_metadata_cache(self):
+        """ Metadata loaded from the cache is the same as that read from the sources """
+        Ldml.ReadMetadata()
+        expected = {k: getattr(Ldml, k) for k in Ldml._metadataattrs}
+        Ldml.LoadMetadata()
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir.name, 'ldmlmetadata.pickle')))
+        for k in Ldml._metadataattrs:
+            setattr(Ldml, k, None)
+        Ldml.LoadMetadata()
+        for k, v in expected.items():
+            self.assertEqual(getattr(Ldml, k), v, msg=k)
+
+    def test_snapshots(self):
+        """ A file read from a snapshot is the same as when parsed """
+        fname = os.path.join(self.tempdir.name, "test.xml")
+        with open(fname, "w", encoding="utf-8") as outf:
+            outf.write(self.tf)
+        oldsnaps, oldstable = Ldml.snapshots, Ldml.use_stablehash
+        Ldml.snapshots = SnapshotCache(os.path.join(self.tempdir.name, 'snapshots'))
+        Ldml.use_stablehash = True
+        try:
+            a = Ldml(fname)
+            b = Ldml(fname)
+            self.assertEqual((Ldml.snapshots.hits, Ldml.snapshots.stores), (1, 1))
+        finally:
+            Ldml.snapshots, Ldml.use_stablehash = oldsnaps, oldstable
+        for x, y in zip(a.root.iter(), b.root.iter()):
+            self.assertEqual((x.tag, x.attrib, x.text, x.contentHash, x.attrHash),
+                             (y.tag, y.attrib, y.text, y.contentHash, y.attrHash))
+        res = StringIO()
+        b.serialize_xml(res.write)
+        self.assertEqual(res.getvalue().strip(), self.tf)
+
+    def test_snapshot_eviction(self):
+        """ The snapshot cache keeps to its size limit, evicting the oldest first """
+        cache = SnapshotCache(self.tempdir.name, maxsize=2000)
+        for i in range(10):
+            cache.put(str(i), "x" * 500)
+        self.assertLessEqual(cache.stats()['size'], 2000)
+        self.assertGreater(cache.evictions, 0)
+        self.assertEqual(cache.get("9"), "x" * 500)
+        self.assertIsNone(cache.get("0"))
+
+    def test_localedir(self):
+        """ Locales are found at the top level first, then in their letter's subdirectory """
+        root = self.tempdir.name
+        for f in ("en.xml", "e/en.xml", "e/en_GB.xml", "f/fr.xml", "f/x/fr_CA.xml", "f/notes.txt"):
+            os.makedirs(os.path.join(root, os.path.dirname(f)), exist_ok=True)
+            with open(os.path.join(root, f), "w") as outf:
+                outf.write(self.tf)
+        d = LocaleDir(root)
+        self.assertEqual(d.find("en"), os.path.join(root, "en.xml"))
+        self.assertEqual(d.find("en", top=False), os.path.join(root, "e", "en.xml"))
+        self.assertEqual(d.find("en_GB"), os.path.join(root, "e", "en_GB.xml"))
+        self.assertIsNone(d.find("fr_CA"))
+        self.assertNotIn("de", d)
+        self.assertEqual(list(d), ["en", "en_GB", "fr"])
+        self.assertEqual(iterate_files(root), sorted(os.path.join(root, f) for f in
+                            ("en.xml", "e/en.xml", "e/en_GB.xml", "f/fr.xml", "f/x/fr_CA.xml")))
+        self.assertEqual(getldml("en-GB", [os.path.join(root, "none"), root]).fname, os.path.join(root, "e", "en_GB.xml"))
+
 if __name__ == '__main__':
     unittest.main()